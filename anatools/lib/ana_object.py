@@ -17,6 +17,7 @@ import logging
 import bpy
 from anatools.lib.search_utils import find_root
 import anatools.lib.bbox as annotations
+from anatools.lib.load import load_datablock, copy_collection
 
 logger = logging.getLogger(__name__)
 
@@ -70,16 +71,24 @@ class AnaObject(ABC):
             - set self.collection = the collection datablock
             - set self.root = the root object datablock
             - set self.loaded = True
+
+        The collection is appended from the file once and cached, see anatools.lib.load. If the
+        "instancing" keyword argument or the "instancing" setting in the object config is true,
+        every object of the type is a copy that shares the cached mesh and material data. Each
+        instance has its own objects, so transforms, pass indices and object level properties
+        are per instance. Changes to shared data such as
+        meshes or materials affect all instances, so don't use instancing for objects whose
+        modifiers edit that data.
        """
         if self.loaded:
             # only load the object once
             return
 
         blender_file = kwargs.pop("blender_file")
+        instancing = kwargs.pop("instancing", (kwargs.get("config") or {}).get("instancing", False))
         # load the collection
-        with bpy.data.libraries.load(filepath="//" + blender_file, link=False) as (_, dt):
-            dt.collections = [self.object_type]
-        self.collection = dt.collections[0]
+        source = load_datablock(blender_file, "collections", self.object_type)
+        self.collection = copy_collection(source, share_data=instancing)
         
         # link collection to the current scene
         bpy.context.scene.collection.children.link(self.collection)
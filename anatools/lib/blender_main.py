@@ -14,11 +14,15 @@
 import sys
 import os
 import argparse
-import yaml
 import logging
 import importlib
 from anatools.lib.channel import Channel
-from anatools.lib.interp import interp
+from anatools.lib.interp import interp_plan, load_plan
+from anatools.lib.work_queue import WorkQueue
+import anatools.lib.profiler as profiler
+import anatools.lib.events as events
+from anatools.lib.prefetch import start_prefetch
+from anatools.lib.blender_session import BlenderSession
 
 logger = logging.getLogger(__name__)
 
@@ -39,6 +43,15 @@ parser.add_argument('--interp_num', type=int)
 parser.add_argument('--preview', action="store_true")
 parser.add_argument('--output')
 parser.add_argument('--data')
+parser.add_argument('--threads', type=int)
+parser.add_argument('--runs', type=int)
+parser.add_argument('--interp_range')
+parser.add_argument('--prune', action="store_true", default=None)
+parser.add_argument('--profile', action="store_true", default=None)
+parser.add_argument('--event_log')
+parser.add_argument('--rng', choices=["legacy", "streams"])
+parser.add_argument('--prefetch', action="store_true", default=None)
+parser.add_argument('--work_queue')
 args = parser.parse_args(argv)
 
 # Configure initial logging (this may get overridden later)
@@ -52,17 +65,57 @@ if os.path.splitext(channel_file)[1] == '':
 channel = Channel(channel_file)
 channel.process_args(args)
 
-# read graph
-with open(args.graph, "r") as f:
-    input_graph = yaml.safe_load(f)
-
 # execute setup
 channel.setup()
 
-# interpret graph
+# read graph, reusing the compiled execution plan if the graph was interpreted before
 try:
-    interp(input_graph)
+    plan = load_plan(args.graph, prune=channel.execution_flags["--prune"])
 except Exception as e:
     message = f"An exception of type {type(e).__name__} occurred while interpreting graph"
     logging.error(message, exc_info=e)
+    sys.exit(1)
+
+# interpret graph once per interpretation number, a failed run doesn't stop the batch. When a
+# work queue is given the interpretation numbers are claimed from the queue shared with other workers.
+work_queue = WorkQueue(args.work_queue) if args.work_queue is not None else None
+interp_nums = work_queue if work_queue is not None else channel.get_interp_nums()
+failed_runs = []
+# the scene after setup is restored before each interpretation after the first
+session = None
+if work_queue is not None or len(interp_nums) > 1:
+    session = BlenderSession(channel)
+if channel.execution_flags["--profile"]:
+    profiler.start_profiling()
+if channel.execution_flags["--event_log"] is not None:
+    events.start_event_stream(channel.execution_flags["--event_log"])
+# read the asset files on background threads while the first interpretation runs, once per batch
+prefetcher = None
+if channel.execution_flags["--prefetch"]:
+    prefetcher = start_prefetch(plan, channel.packages, work_queue)
+for i, interp_num in enumerate(interp_nums):
+    if i > 0 and session is not None:
+        session.reset()
+    channel.initialize_context(interp_num)
+    try:
+        if profiler.active_profiler is not None:
+            with profiler.active_profiler.interpretation(interp_num):
+                interp_plan(plan, threads=channel.execution_flags["--threads"])
+        else:
+            interp_plan(plan, threads=channel.execution_flags["--threads"])
+    except (Exception, SystemExit) as e:
+        # nodes and the interpreter exit on errors, only that run fails
+        message = f"An exception of type {type(e).__name__} occurred while interpreting graph (interp_num {interp_num})"
+        logging.error(message, exc_info=e)
+        failed_runs.append(interp_num)
+    if work_queue is not None:
+        work_queue.finish(interp_num, success=interp_num not in failed_runs)
+
+if profiler.active_profiler is not None:
+    profiler.stop_profiling(channel.execution_flags["--output"])
+events.stop_event_stream()
+if prefetcher is not None:
+    prefetcher.close(channel.execution_flags["--output"])
+
+if len(failed_runs) > 0:
     sys.exit(1)
\ No newline at end of file
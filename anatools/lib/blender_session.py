@@ -0,0 +1,334 @@
+# Copyright 2019-2022 DADoES, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License in the root directory in the "LICENSE" file or at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Runs several interpretations in one Blender process. The datablocks that exist after channel setup
+are recorded along with the saved properties of each of them, e.g. object transforms, render and
+world settings and the objects linked to each collection. Between interpretations every datablock
+created since then is removed and the recorded properties are restored. This is much cheaper than
+starting Blender and running setup again. The main file isn't reopened, so bpy.data.filepath, and
+the blender file paths relative to it, stay the same and references to setup datablocks held by
+channel modules stay valid. Items an interpretation adds to the struct collections of a setup
+datablock, e.g. compositor nodes and links, modifiers and constraints, are removed. If the scene
+can't be restored exactly, e.g. the interpretation removed a setup datablock, the main file is
+reopened and the channel setup is run again. Sources in the library cache of anatools.lib.load, and
+the datablocks they use, are kept so later interpretations reuse them.
+"""
+import logging
+import bpy
+from anatools.lib.ana_object import AnaObject
+from anatools.lib.generator import Generator
+from anatools.lib.load import cached_sources
+
+logger = logging.getLogger(__name__)
+
+# bpy.data collections that hold the user interface rather than the scene
+UI_COLLECTIONS = {"window_managers", "screens", "workspaces"}
+# collections of structs with more items than this, e.g. mesh vertices, aren't recorded
+MAX_COLLECTION_ITEMS = 256
+
+
+def datablock_collections():
+    """ Return the name and datablocks of each bpy.data collection """
+    collections = {}
+    for attribute in dir(bpy.data):
+        collection = getattr(bpy.data, attribute, None)
+        if isinstance(collection, bpy.types.bpy_prop_collection):
+            collections[attribute] = collection
+    return collections
+
+
+def kept_datablocks(datablocks, sources):
+    """ Return the pointers of the sources and of the datablocks they use, directly or indirectly """
+    kept = {source.as_pointer() for source in sources}
+    users = bpy.data.user_map(subset=datablocks)
+    # a datablock is kept if a kept datablock uses it, repeat until nothing new is kept
+    pending = list(datablocks)
+    while pending:
+        remaining = []
+        for datablock in pending:
+            if datablock.as_pointer() in kept:
+                continue
+            if any(user.as_pointer() in kept for user in users.get(datablock, ())):
+                kept.add(datablock.as_pointer())
+            else:
+                remaining.append(datablock)
+        if len(remaining) == len(pending):
+            break
+        pending = remaining
+    return kept
+
+
+def freeze(value):
+    """ Return a copy of a property value that doesn't change with the property """
+    if isinstance(value, bpy.types.bpy_struct):
+        # datablock references are compared by identity
+        return value
+    if hasattr(value, "copy"):
+        # mathutils values and enum flag sets
+        return value.copy()
+    if isinstance(value, bpy.types.bpy_prop_array):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def record_struct(struct, seen):
+    """
+    Record the saved properties of a struct. Returns a dictionary with the values of the writable
+    properties, including references to other datablocks, the records of nested structs, the
+    pointer and record of each item of struct collections, the links of a node tree and the
+    members of a collection datablock.
+    """
+    record = {"values": {}, "structs": {}, "items": {}, "lengths": {}, "links": None, "members": {}}
+    key = (type(struct).__name__, struct.as_pointer())
+    if key in seen:
+        return record
+    seen.add(key)
+    if isinstance(struct, bpy.types.Collection):
+        record["members"]["objects"] = list(struct.objects)
+        record["members"]["children"] = list(struct.children)
+    if isinstance(struct, bpy.types.NodeTree):
+        record["links"] = [(link.as_pointer(), link.from_socket, link.to_socket) for link in struct.links]
+    for prop in struct.bl_rna.properties:
+        identifier = prop.identifier
+        if identifier == "rna_type" or prop.is_skip_save:
+            continue
+        if prop.type == "POINTER":
+            value = getattr(struct, identifier)
+            if not prop.is_readonly:
+                if value is None or isinstance(value, bpy.types.ID):
+                    record["values"][identifier] = value
+            elif value is not None and (not isinstance(value, bpy.types.ID) or getattr(value, "is_embedded_data", False)):
+                record["structs"][identifier] = record_struct(value, seen)
+        elif prop.type == "COLLECTION":
+            if identifier in record["members"] or (identifier == "links" and record["links"] is not None):
+                continue
+            items = getattr(struct, identifier)
+            if len(items) > MAX_COLLECTION_ITEMS or any(isinstance(item, bpy.types.ID) for item in items):
+                # bulk data like mesh vertices only has its length checked
+                record["lengths"][identifier] = len(items)
+                continue
+            record["items"][identifier] = [(item.as_pointer(), record_struct(item, seen)) for item in items]
+        elif not prop.is_readonly:
+            # dynamic arrays like image pixels are data rather than settings
+            if getattr(prop, "is_array", False) and prop.array_length == 0:
+                continue
+            record["values"][identifier] = freeze(getattr(struct, identifier))
+    return record
+
+
+def restore_struct(struct, record):
+    """
+    Set the properties of a struct that differ from its record, see record_struct. Items added to
+    struct collections that can remove items, e.g. nodes, node links, modifiers and constraints,
+    are removed. Returns False if the struct couldn't be restored exactly, e.g. an item of the
+    record is missing or a collection changed length and can't remove items.
+    """
+    exact = True
+    for identifier, value in record["values"].items():
+        try:
+            if freeze(getattr(struct, identifier)) != value:
+                setattr(struct, identifier, value)
+        except (AttributeError, TypeError, ValueError, RuntimeError, ReferenceError) as e:
+            logger.debug(f"Can't restore property '{identifier}' of {struct!r}: {e}")
+    for identifier, struct_record in record["structs"].items():
+        value = getattr(struct, identifier, None)
+        if value is not None:
+            exact = restore_struct(value, struct_record) and exact
+    if record["links"] is not None:
+        exact = restore_links(struct.links, record["links"]) and exact
+    for identifier, item_records in record["items"].items():
+        exact = restore_items(getattr(struct, identifier), item_records) and exact
+    for identifier, length in record["lengths"].items():
+        if len(getattr(struct, identifier)) != length:
+            logger.debug(f"Collection '{identifier}' of {struct!r} changed length")
+            exact = False
+    for identifier, members in record["members"].items():
+        exact = restore_members(getattr(struct, identifier), members) and exact
+    return exact
+
+
+def restore_items(collection, item_records):
+    """ Remove the items added to a struct collection and restore the recorded ones, see restore_struct """
+    pointers = {pointer for pointer, _ in item_records}
+    added = [item for item in collection if item.as_pointer() not in pointers]
+    if added:
+        if not hasattr(collection, "remove"):
+            logger.debug(f"Can't remove the items added to {collection!r}")
+            return False
+        try:
+            for item in added:
+                collection.remove(item)
+        except (TypeError, RuntimeError, ReferenceError) as e:
+            logger.debug(f"Can't remove the items added to {collection!r}: {e}")
+            return False
+    items = {item.as_pointer(): item for item in collection}
+    exact = True
+    for pointer, item_record in item_records:
+        item = items.get(pointer)
+        if item is None:
+            logger.debug(f"An item of {collection!r} was removed")
+            exact = False
+        else:
+            exact = restore_struct(item, item_record) and exact
+    return exact
+
+
+def restore_links(links, link_records):
+    """ Remove the links added to a node tree and link the recorded sockets again, see record_struct """
+    try:
+        pointers = {pointer for pointer, _, _ in link_records}
+        for link in [link for link in links if link.as_pointer() not in pointers]:
+            links.remove(link)
+        current = {link.as_pointer() for link in links}
+        for pointer, from_socket, to_socket in link_records:
+            if pointer not in current:
+                links.new(from_socket, to_socket)
+    except (RuntimeError, ReferenceError) as e:
+        logger.debug(f"Can't restore the links of {links!r}: {e}")
+        return False
+    return True
+
+
+def restore_members(collection, members):
+    """ Link and unlink the objects or child collections of a collection to match its record """
+    try:
+        member_pointers = {member.as_pointer() for member in members}
+        for member in list(collection):
+            if member.as_pointer() not in member_pointers:
+                collection.unlink(member)
+        current = {member.as_pointer() for member in collection}
+        for member in members:
+            if member.as_pointer() not in current:
+                collection.link(member)
+    except (RuntimeError, ReferenceError) as e:
+        logger.debug(f"Can't restore the members of {collection!r}: {e}")
+        return False
+    return True
+
+
+def record_properties(datablock):
+    """ Record the saved properties and custom properties of a datablock """
+    record = record_struct(datablock, set())
+    # add-on properties like 'cycles' are stored as custom properties too, they're recorded above
+    registered = set(datablock.bl_rna.properties.keys())
+    record["custom"] = {key: freeze_custom(datablock[key]) for key in datablock.keys() if key not in registered}
+    return record
+
+
+def freeze_custom(value):
+    """ Return a plain copy of a custom property value """
+    if hasattr(value, "to_dict"):
+        return value.to_dict()
+    if hasattr(value, "to_list"):
+        return value.to_list()
+    return value
+
+
+def restore_properties(datablock, record):
+    """
+    Restore the saved properties and custom properties of a datablock, see record_properties.
+    Returns False if the datablock couldn't be restored exactly.
+    """
+    exact = restore_struct(datablock, record)
+    custom = record["custom"]
+    registered = set(datablock.bl_rna.properties.keys())
+    for key in list(datablock.keys()):
+        if key not in custom and key not in registered:
+            del datablock[key]
+    for key, value in custom.items():
+        if key not in datablock or freeze_custom(datablock[key]) != value:
+            datablock[key] = value
+    return exact
+
+
+def count_datablocks():
+    """ Return the number of datablocks in each bpy.data collection """
+    return {attribute: len(collection) for attribute, collection in datablock_collections().items()}
+
+
+class BlenderSession:
+    """
+    Records the datablocks after channel setup, removes new ones between interpretations and
+    restores the properties of the recorded ones. If the scene can't be restored exactly the main
+    file is reopened and the channel setup is run again.
+    """
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.filepath = bpy.data.filepath
+        self.record()
+
+    def record(self):
+        """ Record the setup datablocks and their properties """
+        self.base_datablocks = {
+            attribute: {datablock.as_pointer() for datablock in collection}
+            for attribute, collection in datablock_collections().items()}
+        self.base_counts = count_datablocks()
+        self.base_properties = [
+            (datablock, record_properties(datablock))
+            for attribute, collection in datablock_collections().items() if attribute not in UI_COLLECTIONS
+            for datablock in collection]
+
+    def reset(self):
+        """
+        Remove the datablocks of the last interpretation, restore the setup datablocks and reset
+        the class level state of the last interpretation
+        """
+        new_datablocks = []
+        for attribute, collection in datablock_collections().items():
+            base = self.base_datablocks.get(attribute, set())
+            new_datablocks.extend(datablock for datablock in collection if datablock.as_pointer() not in base)
+        kept = kept_datablocks(new_datablocks, cached_sources())
+        new_datablocks = [datablock for datablock in new_datablocks if datablock.as_pointer() not in kept]
+        if new_datablocks:
+            bpy.data.batch_remove(new_datablocks)
+        exact = self.restore_properties()
+        AnaObject.next_instance = 1
+        Generator.reset_registry()
+        if self.check_datablocks(kept) or not exact:
+            self.reload()
+
+    def restore_properties(self):
+        """ Restore the recorded properties of the setup datablocks, returns False if any weren't restored exactly """
+        exact = True
+        for datablock, record in self.base_properties:
+            try:
+                datablock.name
+            except ReferenceError:
+                logger.debug("A setup datablock was removed by the interpretation")
+                exact = False
+                continue
+            exact = restore_properties(datablock, record) and exact
+        return exact
+
+    def reload(self):
+        """ Reopen the main file and run the channel setup again """
+        if not self.filepath:
+            logger.warning("The scene couldn't be restored and there is no main file to reopen")
+            return
+        logger.warning("The scene couldn't be restored, reopening the main file and running setup again")
+        bpy.ops.wm.open_mainfile(filepath=self.filepath)
+        self.channel.setup()
+        self.record()
+
+    def check_datablocks(self, kept=()):
+        """ Warn if datablocks other than the kept ones are accumulating across interpretations """
+        counts = {attribute: sum(1 for datablock in collection if datablock.as_pointer() not in kept)
+            for attribute, collection in datablock_collections().items()}
+        grown = {name: (self.base_counts.get(name, 0), count)
+            for name, count in counts.items() if count > self.base_counts.get(name, 0)}
+        if grown:
+            details = ", ".join(f"{name} {base} -> {count}" for name, (base, count) in sorted(grown.items()))
+            logger.info(f"Datablocks remain after resetting the scene: {details}")
+        return grown
@@ -12,17 +12,42 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import yaml
+import copy
 import glob
+import json
+import queue
+import atexit
+import hashlib
 import logging
+import logging.handlers
 import os
+import re
 import sys
 import importlib
+import importlib.util
 from pathlib import Path
 import anatools
 import anatools.lib.context as ctx
+from anatools.lib.disk_cache import read_cache, write_cache
+
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
 
 logger = logging.getLogger(__name__)
 
+# bump when the cached channel state changes so channels cached on disk are resolved again
+CHANNEL_CACHE_VERSION = 1
+# Channel attributes that are saved in the channel cache
+CACHED_ATTRIBUTES = [
+    "classes", "schemas", "packages", "type", "setup_modules", "node_menu", "name", "default_execution_flags"]
+
+
+def load_yaml(f):
+    """ Parse a YAML document safely, using the C loader when libyaml is available """
+    return yaml.load(f, Loader=YamlLoader)
+
 
 def find_channelfile():
     channel = None
@@ -40,16 +65,48 @@ def find_channelfile():
     if os.path.exists('/ana'):
         anafiles = [f'/ana/{file}' for file in os.listdir(f'/ana') if file.endswith('.yml') or file.endswith('.yaml') ]
         for file in anafiles: channelfiles.append(file)
+    # reuse the last result if none of the candidate files have changed
+    candidates = []
     for channelfile in channelfiles:
-        with open(channelfile, 'r') as f:
-            cfg = yaml.safe_load(f)
+        try:
+            stat = os.stat(channelfile)
+            candidates.append((channelfile, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            candidates.append((channelfile, None, None))
+    cache_key = hashlib.sha256(json.dumps([CHANNEL_CACHE_VERSION, os.getcwd()]).encode()).hexdigest()
+    cached = read_cache("channelfiles", cache_key)
+    if cached is not None and cached["candidates"] == candidates:
+        channel = cached["channel"]
+    else:
+        for channelfile in channelfiles:
             # if it adds packages then assume it's a channel file
-            if "add_packages" in cfg:
+            if has_top_level_key(channelfile, "add_packages"):
                 channel = channelfile
-                print(f'Using channelfile found at {channel}.\nIf this is the wrong channel, specify a channelfile using the --channel argument.')
                 break
+        write_cache("channelfiles", cache_key, {"candidates": candidates, "channel": channel})
+    if channel is not None:
+        print(f'Using channelfile found at {channel}.\nIf this is the wrong channel, specify a channelfile using the --channel argument.')
     return channel
 
+def has_top_level_key(yaml_file, key):
+    """
+    Check if a YAML file has a top level key without parsing the whole document. Only unindented
+    lines are looked at, documents that start with a flow mapping are fully parsed.
+    """
+    key_pattern = re.compile(r"""^(["']?){}\1\s*:""".format(re.escape(key)))
+    try:
+        with open(yaml_file, 'r') as f:
+            for line in f:
+                if line.startswith("{"):
+                    f.seek(0)
+                    cfg = load_yaml(f)
+                    return isinstance(cfg, dict) and key in cfg
+                if key_pattern.match(line):
+                    return True
+    except (OSError, UnicodeDecodeError, yaml.YAMLError):
+        pass
+    return False
+
 def get_schema_files(package_name):
     ''' Return a list of all schema files in the package '''
     try:
@@ -69,9 +126,113 @@ def get_schema_files(package_name):
         schema_files = glob.glob(os.path.join(node_dir, "*.yml"))
     return schema_files
 
+def get_schema_index(package_name):
+    """
+    Parse all schema files in the package and return a dictionary that maps each node class name to
+    {"module": python module, "schema": schema}. If a class is defined in more than one schema file
+    the first one found is used.
+    """
+    index = {}
+    for schema_file in get_schema_files(package_name):
+        try:
+            with open(schema_file, "r") as f:
+                schema_module = load_yaml(f)
+        except:
+            logger.critical(f"Error reading schema '{schema_file}'")
+            raise
+        python_module = package_name + ".nodes." + Path(schema_file).stem
+        for schema in schema_module["schemas"]:
+            if schema not in index:
+                index[schema] = {"module": python_module, "schema": schema_module["schemas"][schema]}
+    return index
+
+def get_package_dir(package_name):
+    """ Return the directory of a package without importing it, or None if it can't be found """
+    try:
+        spec = importlib.util.find_spec(package_name)
+    except (ImportError, ValueError):
+        return None
+    if spec is None or spec.origin is None:
+        return None
+    return os.path.dirname(os.path.realpath(spec.origin))
+
+def file_digest(path):
+    """ Return the SHA-256 of a file's contents """
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def file_state(path):
+    """ Return (path, mtime, size, digest) for a file, or (path, None, None, None) if it doesn't exist """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return (path, None, None, None)
+    return (path, stat.st_mtime_ns, stat.st_size, file_digest(path))
+
+def channel_cache_key(channel_file):
+    """
+    Return the cache key of a channel file. Relative paths in channel files depend on the cwd.
+    sys.path isn't part of the key so ana and the interpreter processes it starts share entries,
+    the package locations are checked by channel_dependencies instead.
+    """
+    data = json.dumps([
+        CHANNEL_CACHE_VERSION, anatools.__version__, sys.version, os.getcwd(),
+        os.path.abspath(channel_file)])
+    return hashlib.sha256(data.encode()).hexdigest()
+
+def channel_dependencies(channel_files, package_names):
+    """
+    Record the state of everything a resolved channel depends on: the channel files, where each
+    package is installed, the schema files in each package and the package configuration files.
+    Returns None if a package location can't be determined.
+    """
+    files = list(channel_files)
+    node_dirs = []
+    package_dirs = {}
+    for package_name in package_names:
+        package_dir = get_package_dir(package_name)
+        if package_dir is None:
+            return None
+        package_dirs[package_name] = package_dir
+        node_dir = os.path.join(package_dir, "nodes")
+        schema_files = sorted(glob.glob(os.path.join(node_dir, "*.yml")))
+        node_dirs.append((node_dir, schema_files))
+        files.extend(schema_files)
+        files.append(os.path.join(package_dir, "package.yml"))
+    return {
+        "files": [file_state(path) for path in files],
+        "node_dirs": node_dirs,
+        "package_dirs": package_dirs
+    }
+
+def dependencies_changed(dependencies):
+    """ Check if anything recorded by channel_dependencies has changed """
+    for path, mtime, size, digest in dependencies["files"]:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            if mtime is None:
+                continue
+            return True
+        if mtime is None or stat.st_size != size:
+            return True
+        # a new mtime with the same contents, e.g. after a checkout, doesn't invalidate the cache
+        if stat.st_mtime_ns != mtime and file_digest(path) != digest:
+            return True
+    for node_dir, schema_files in dependencies["node_dirs"]:
+        if sorted(glob.glob(os.path.join(node_dir, "*.yml"))) != schema_files:
+            return True
+    for package_name, package_dir in dependencies["package_dirs"].items():
+        if get_package_dir(package_name) != package_dir:
+            return True
+    return False
+
 class Channel:
     console_logging_configured = False
     logfile_logging_configured = False
+    log_queue = queue.Queue()
+    log_handlers = []
+    log_listener = None
     def __init__(self, channel_file):
         """ Create a channel class from a channel file """
         self.classes = {}
@@ -93,7 +254,15 @@ class Channel:
             "--interp_num": 0,
             "--preview": False,
             "--output": "./output",
-            "--data": "./data"
+            "--data": "./data",
+            "--threads": 0,
+            "--runs": 1,
+            "--interp_range": None,
+            "--prune": False,
+            "--profile": False,
+            "--event_log": None,
+            "--rng": "legacy",
+            "--prefetch": False
         }
 
         # default channel settings
@@ -101,12 +270,35 @@ class Channel:
             "type": "blender"
         }
 
+        # load the resolved channel from the cache if none of the files it was resolved from have changed
+        cache_key = channel_cache_key(channel_file)
+        cached = read_cache("channels", cache_key)
+        if cached is not None and not dependencies_changed(cached["dependencies"]):
+            self.__dict__.update(cached["state"])
+        else:
+            channel_file_list, package_list = self._load(channel_file)
+            dependencies = channel_dependencies(channel_file_list, package_list)
+            if dependencies is not None:
+                state = {attribute: getattr(self, attribute) for attribute in CACHED_ATTRIBUTES}
+                write_cache("channels", cache_key, {"dependencies": dependencies, "state": state})
+        self.execution_flags = {**self.execution_flags, **self.default_execution_flags}
+
+        self._schema_hash = None
+
+    def _load(self, channel_file):
+        """
+        Resolve the channel from the channel file and its bases. Returns the channel files and the
+        packages that were read.
+        """
+        # execution flags set by the channel files
+        self.default_execution_flags = {}
+
         # get an ordered list of the channel files to load
         done = False
         channel_file_list = [channel_file]
         while not done:
             with open(channel_file, 'r') as f:
-                cfg = yaml.safe_load(f)
+                cfg = load_yaml(f)
 
             if "channel" in cfg and "base" in cfg["channel"]:
                 channel_file = cfg["channel"]["base"]
@@ -128,7 +320,7 @@ class Channel:
         rename_nodes = []
         for channel_file in channel_file_list:
             with open(channel_file, 'r') as f:
-                cfg = yaml.safe_load(f)
+                cfg = load_yaml(f)
             if "channel" in cfg:
                 channel_settings = {**channel_settings, **cfg["channel"]}
             if "add_setup" in cfg:
@@ -147,7 +339,7 @@ class Channel:
                 rename_nodes.extend(cfg["rename_nodes"])
             if "default_execution_flags" in cfg:
                 # channel file defaults take precedence
-                self.execution_flags = {**self.execution_flags, **cfg["default_execution_flags"]}
+                self.default_execution_flags = {**self.default_execution_flags, **cfg["default_execution_flags"]}
 
         # save channel settings
         self.type = channel_settings["type"]
@@ -177,28 +369,26 @@ class Channel:
                 logger.critical(f"Can't remove package {remove_package}. Not found.")
                 raise ValueError
         
+        # each package's schema files are parsed once and shared by add_packages and add_nodes
+        schema_indexes = {}
+        def get_package_index(package):
+            if package not in schema_indexes:
+                schema_indexes[package] = get_schema_index(package)
+            return schema_indexes[package]
+
         # import packages
         package_list = []
         for package in add_packages:
             if package not in package_list:
                 package_list.append(package)
-                schema_files = get_schema_files(package)
                 
-                # load schemas and save class info
-                for schema_file in schema_files:
-                    try:
-                        with open(schema_file, "r") as f:
-                            schema_module = yaml.safe_load(f)
-                    except:
-                        logger.critical(f"Error reading schema '{schema_file}'")
-                        raise
-                    python_module = package + ".nodes." + Path(schema_file).stem
-                    for schema in schema_module["schemas"]:
-                        alias = schema_module["schemas"][schema].get("alias", schema)
-                        self.schemas[alias] = schema_module["schemas"][schema]
-                        self.classes[alias] = {
-                            "module": python_module,
-                            "class": schema
+                # save schema and class info
+                for schema, entry in get_package_index(package).items():
+                    alias = entry["schema"].get("alias", schema)
+                    self.schemas[alias] = copy.deepcopy(entry["schema"])
+                    self.classes[alias] = {
+                        "module": entry["module"],
+                        "class": schema
                     }
 
         # add nodes
@@ -211,45 +401,28 @@ class Channel:
             category = node_dict.get("category", None)
             subcategory = node_dict.get("subcategory", None)
             color = node_dict.get("color", None)
-            # get all the schema files in the package
-            schema_files = get_schema_files(package)
-            if len(schema_files) == 0:
-                logger.critical(f"Schema for '{node_name}' not found")
-                raise ValueError
-            
-            # search all schemas in the package for the node name
-            found = False
-            for schema_file in schema_files:
-                try:
-                    with open(schema_file, "r") as f:
-                        schema_module = yaml.safe_load(f)
-                except:
-                    logger.critical(f"Error reading schema '{schema_file}'")
-                    raise
-                for schema in schema_module["schemas"]:
-                    if schema == node_name:
-                        python_module = package + ".nodes." + Path(schema_file).stem
-                        # check if schema file included an alias
-                        original_alias = schema_module["schemas"][schema].get("alias", node_name)
-                        if alias is None: alias = original_alias
-                        if category: schema_module["schemas"][schema]['category'] = category
-                        if subcategory: schema_module["schemas"][schema]['subcategory'] = subcategory
-                        if color: schema_module["schemas"][schema]['color'] = color
-                        self.schemas[alias] = schema_module["schemas"][schema]
-                        self.classes[alias] = {
-                            "module": python_module,
-                            "class": schema
-                        }
-                        found = True
-                        break
-                if found:
-                    break
-            if not found:
+            # look up the node name in the package's schemas
+            entry = get_package_index(package).get(node_name)
+            if entry is None:
                 logger.critical(f"Schema for '{node_name}' not found")
                 raise ValueError
+            schema = copy.deepcopy(entry["schema"])
+            # check if schema file included an alias
+            if alias is None: alias = schema.get("alias", node_name)
+            if category: schema['category'] = category
+            if subcategory: schema['subcategory'] = subcategory
+            if color: schema['color'] = color
+            self.schemas[alias] = schema
+            self.classes[alias] = {
+                "module": entry["module"],
+                "class": node_name
+            }
 
         # remove nodes
         for node_name in remove_nodes:
+            if node_name not in self.schemas:
+                logger.critical(f"Can't remove node - '{node_name}' not found.")
+                raise ValueError
             self.schemas.pop(node_name)
             self.classes.pop(node_name)
 
@@ -271,7 +444,7 @@ class Channel:
             package_config_file = os.path.join(package_dir, "package.yml")
             if os.path.exists(package_config_file):
                 with open(package_config_file, "r") as f:
-                    self.packages[package_name] = yaml.safe_load(f)
+                    self.packages[package_name] = load_yaml(f)
             else:
                 self.packages[package_name] = {}
 
@@ -283,8 +456,15 @@ class Channel:
 
         self.name = os.path.splitext(os.path.basename(channel_file))[0]
 
+        return channel_file_list, package_list
+
     @classmethod
     def configure_logging(cls, loglevel="ERROR", logfile=None, logfile_mode="w"):
+        """
+        Configure the root logger. The message of a record is built when it is logged, then the
+        record is put on a queue and written to the console and log file by a listener thread, so
+        logging doesn't block interpretation on I/O.
+        """
 
         # set up logging
         rootLogger = logging.getLogger()
@@ -300,16 +480,33 @@ class Channel:
         if not Channel.logfile_logging_configured and logfile is not None:
             fileHandler = logging.FileHandler(logfile, mode=logfile_mode)
             fileHandler.setFormatter(formatter)
-            rootLogger.addHandler(fileHandler)
+            Channel.log_handlers.append(fileHandler)
             Channel.logfile_logging_configured = True
 
         # log to console
         if not Channel.console_logging_configured:
             consoleHandler = logging.StreamHandler()
             consoleHandler.setFormatter(formatter)
-            rootLogger.addHandler(consoleHandler)
+            Channel.log_handlers.append(consoleHandler)
             Channel.console_logging_configured = True
 
+        # restart the listener so it writes to all the handlers
+        if Channel.log_listener is None:
+            rootLogger.addHandler(logging.handlers.QueueHandler(Channel.log_queue))
+            atexit.register(Channel.stop_logging)
+        else:
+            Channel.log_listener.stop()
+        Channel.log_listener = logging.handlers.QueueListener(
+            Channel.log_queue, *Channel.log_handlers, respect_handler_level=True)
+        Channel.log_listener.start()
+
+    @classmethod
+    def stop_logging(cls):
+        """ Write all queued log records and stop the listener thread """
+        if Channel.log_listener is not None:
+            Channel.log_listener.stop()
+            Channel.log_listener = None
+
 
     def process_args(self, args):
         if args.channel is not None:
@@ -330,6 +527,22 @@ class Channel:
             self.execution_flags["--output"] = args.output
         if args.data is not None:
             self.execution_flags["--data"] = args.data
+        if args.threads is not None:
+            self.execution_flags["--threads"] = args.threads
+        if args.runs is not None:
+            self.execution_flags["--runs"] = args.runs
+        if args.interp_range is not None:
+            self.execution_flags["--interp_range"] = args.interp_range
+        if args.prune is not None:
+            self.execution_flags["--prune"] = args.prune
+        if args.profile is not None:
+            self.execution_flags["--profile"] = args.profile
+        if args.event_log is not None:
+            self.execution_flags["--event_log"] = args.event_log
+        if args.rng is not None:
+            self.execution_flags["--rng"] = args.rng
+        if args.prefetch is not None:
+            self.execution_flags["--prefetch"] = args.prefetch
         
         # Configure logging
         Channel.configure_logging(
@@ -338,6 +551,12 @@ class Channel:
             logfile_mode="a"
         )
 
+        # check the interpretation numbers before anything is loaded
+        try:
+            self.get_interp_nums()
+        except ValueError:
+            sys.exit(1)
+
         # Configure global variables
         ctx.initialize(
             channel=self,
@@ -345,7 +564,40 @@ class Channel:
             interp_num=self.execution_flags["--interp_num"],
             preview=self.execution_flags["--preview"],
             output=self.execution_flags["--output"],
-            data=self.execution_flags["--data"])
+            data=self.execution_flags["--data"],
+            rng=self.execution_flags["--rng"])
+
+    def schema_hash(self):
+        """ Return a hash of the node schemas and classes, used to key data derived from them """
+        if self._schema_hash is None:
+            data = json.dumps([self.schemas, self.classes], sort_keys=True, default=str)
+            self._schema_hash = hashlib.sha256(data.encode()).hexdigest()
+        return self._schema_hash
+
+    def get_interp_nums(self):
+        """ Return the interpretation numbers to run, from --interp_range 'a:b' or --interp_num and --runs """
+        interp_range = self.execution_flags["--interp_range"]
+        if interp_range is not None:
+            try:
+                start, stop = [int(value) for value in str(interp_range).split(":")]
+            except ValueError:
+                logger.critical(f"Invalid interp_range '{interp_range}'. Expected 'start:stop'.")
+                raise
+            return list(range(start, stop))
+        start = int(self.execution_flags["--interp_num"])
+        return list(range(start, start + int(self.execution_flags["--runs"])))
+
+    def initialize_context(self, interp_num):
+        """ Re-initialize global variables for another interpretation in the same process """
+        # keep the seed of the first run so each run is seeded with seed + interp_num
+        ctx.initialize(
+            channel=self,
+            seed=ctx.seed,
+            interp_num=interp_num,
+            preview=self.execution_flags["--preview"],
+            output=self.execution_flags["--output"],
+            data=self.execution_flags["--data"],
+            rng=self.execution_flags["--rng"])
 
     def setup(self):
         """ Execute channel setup modules """
@@ -13,7 +13,15 @@
 # limitations under the License.
 import os
 import time
-from numpy.random import RandomState
+import hashlib
+import threading
+from contextlib import contextmanager
+from numpy.random import RandomState, Generator, PCG64, SeedSequence
+
+# random number modes. In "legacy" mode every node draws from one RandomState seeded with
+# seed + interp_num, so results depend on the order nodes are executed in. In "streams" mode each
+# node draws from its own PCG64 stream derived from the seed, interp_num and node name.
+RNG_MODES = ["legacy", "streams"]
 
 initialized = False
 channel = None
@@ -25,8 +33,75 @@ data = None
 random = None
 packages = None
 channel = None
+rng_mode = "legacy"
+reset_hooks = []
+node_streams = {}
+_current_stream = threading.local()
+
+
+class StreamRandom:
+    """
+    Stands in for ctx.random in "streams" mode. Calls go to the RandomState of the node the calling
+    thread is executing, or to the interpretation's stream outside of node execution.
+    """
+
+    def __getattr__(self, name):
+        random_state = getattr(_current_stream, "random_state", None)
+        if random_state is None:
+            random_state = get_node_stream(None)[0]
+        return getattr(random_state, name)
+
+
+def _spawn_key(name):
+    """ Return a stable spawn key for a node name, independent of PYTHONHASHSEED """
+    if name is None:
+        return (interp_num,)
+    digest = hashlib.sha256(name.encode()).digest()
+    return (interp_num,) + tuple(int.from_bytes(digest[i:i+4], "little") for i in range(0, 16, 4))
+
+
+def get_node_stream(name):
+    """
+    Return the (RandomState, Generator) pair for a node. Both draw from the same PCG64 stream,
+    spawned from the seed with a key made from interp_num and the node name, so a node gets the
+    same numbers no matter when or on which thread it runs.
+    """
+    streams = node_streams.get(name)
+    if streams is None:
+        bit_generator = PCG64(SeedSequence(seed, spawn_key=_spawn_key(name)))
+        streams = node_streams.setdefault(name, (RandomState(bit_generator), Generator(bit_generator)))
+    return streams
+
 
-def initialize(channel, seed=None, interp_num=0, preview=False, output="./output", data="./data"):
+def get_node_rng(name):
+    """ Return the numpy.random.Generator for a node. Nodes get their own stream in every rng mode. """
+    return get_node_stream(name)[1]
+
+
+@contextmanager
+def node_stream(name):
+    """ Send ctx.random calls made by this thread to the node's stream while the node executes """
+    previous = getattr(_current_stream, "random_state", None)
+    _current_stream.random_state = get_node_stream(name)[0]
+    try:
+        yield
+    finally:
+        _current_stream.random_state = previous
+
+
+def add_reset_hook(hook):
+    """ Register a function the interpreter calls before each interpretation to drop state left by earlier ones """
+    if hook not in reset_hooks:
+        reset_hooks.append(hook)
+
+
+def reset():
+    """ Call the reset hooks """
+    for hook in reset_hooks:
+        hook()
+
+
+def initialize(channel, seed=None, interp_num=0, preview=False, output="./output", data="./data", rng="legacy"):
     """ Initialize Ana configuration """
 
     globals()['channel'] = channel
@@ -49,7 +124,14 @@ def initialize(channel, seed=None, interp_num=0, preview=False, output="./output
     globals()['data'] = data
 
     # use this for repeatable random distributions, e.g. self.ctx.ana_random.uniform(0,1)
-    globals()['random'] = RandomState(globals()['seed'] + interp_num)
+    if rng not in RNG_MODES:
+        raise ValueError(f"Invalid rng mode '{rng}'. Expected one of {RNG_MODES}.")
+    globals()['rng_mode'] = rng
+    globals()['node_streams'] = {}
+    if rng == "legacy":
+        globals()['random'] = RandomState(globals()['seed'] + interp_num)
+    else:
+        globals()['random'] = StreamRandom()
 
     # make package configurations available to all nodes
     globals()['packages'] = channel.packages
@@ -0,0 +1,69 @@
+# Copyright 2019-2022 DADoES, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License in the root directory in the "LICENSE" file or at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Helpers for caching data on disk between processes. The cache lives in the directory named by the
+ANA_CACHE_DIR environment variable, or ~/.cache/anatools if it isn't set. Set ANA_CACHE_DIR to an
+empty string to disable the disk cache. Failing to read or write the cache is never an error, the
+caller just recomputes the data.
+"""
+import os
+import pickle
+import logging
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+
+def get_cache_dir(subdir):
+    """ Return the cache directory for subdir, or None if the disk cache is disabled """
+    cache_dir = os.environ.get("ANA_CACHE_DIR")
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "anatools")
+    if cache_dir == "":
+        return None
+    return os.path.join(cache_dir, subdir)
+
+
+def read_cache(subdir, key):
+    """ Return the object cached under key, or None if it isn't cached """
+    cache_dir = get_cache_dir(subdir)
+    if cache_dir is None:
+        return None
+    path = os.path.join(cache_dir, key + ".pickle")
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.debug("Ignoring unreadable cache file '%s': %s", path, e)
+        return None
+
+
+def write_cache(subdir, key, obj):
+    """ Cache obj under key. The file is replaced atomically so concurrent readers never see a partial file. """
+    cache_dir = get_cache_dir(subdir)
+    if cache_dir is None:
+        return
+    tmp_path = None
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(obj, f, protocol=4)
+        os.replace(tmp_path, os.path.join(cache_dir, key + ".pickle"))
+    except Exception as e:
+        logger.debug("Unable to write cache file for '%s' in '%s': %s", key, cache_dir, e)
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
@@ -0,0 +1,121 @@
+# Copyright 2019-2022 DADoES, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License in the root directory in the "LICENSE" file or at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+A structured stream of node events. When the stream is started every node execution is recorded
+as one line of JSON in the event log, e.g.
+
+    {"event": "node", "pid": 12, "interp_num": 3, "name": "Sink_1", "class": "Sink",
+     "start": 1660000000.25, "duration": 0.0012, "status": "ok"}
+
+The status is 'cached' when a pure node's outputs were reused from the cache, and 'error' when
+the node raised an exception.
+
+Interpreting threads only put a tuple on a queue, the JSON is built and written by a background
+thread. Several processes can append to the same event log.
+"""
+import os
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+import anatools.lib.context as ctx
+
+logger = logging.getLogger(__name__)
+
+# the event stream used by the interpreter, None when the stream is off
+active_stream = None
+
+
+def start_event_stream(filename):
+    """ Start recording node events to a file """
+    global active_stream
+    if active_stream is None:
+        active_stream = EventStream(filename)
+        atexit.register(stop_event_stream)
+    return active_stream
+
+
+def stop_event_stream():
+    """ Write the queued events and stop the event stream """
+    global active_stream
+    if active_stream is not None:
+        active_stream.close()
+        active_stream = None
+
+
+class EventStream:
+    """ Writes node events to a JSON lines file from a background thread """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.pid = os.getpid()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._write_events, name="anatools-events", daemon=True)
+        self._thread.start()
+
+    def record_node(self, node, method, status="ok"):
+        """ Call method(node) and record a node event with the status, or 'error' if method raises """
+        start = time.time()
+        start_counter = time.perf_counter()
+        succeeded = False
+        try:
+            outputs = method(node)
+            succeeded = True
+            return outputs
+        finally:
+            self._queue.put((ctx.interp_num, node.name, node.__class__.__name__, start,
+                time.perf_counter() - start_counter, status if succeeded else "error"))
+
+    def _format_event(self, event):
+        interp_num, name, class_name, start, duration, status = event
+        return json.dumps({
+            "event": "node",
+            "pid": self.pid,
+            "interp_num": interp_num,
+            "name": name,
+            "class": class_name,
+            "start": start,
+            "duration": duration,
+            "status": status
+        }) + "\n"
+
+    def _write_events(self):
+        fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            done = False
+            while not done:
+                # write every queued event with a single append so lines from other processes aren't split
+                lines = []
+                event = self._queue.get()
+                while True:
+                    if event is None:
+                        done = True
+                        break
+                    lines.append(self._format_event(event))
+                    try:
+                        event = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                if lines:
+                    os.write(fd, "".join(lines).encode())
+        finally:
+            os.close(fd)
+
+    def close(self):
+        """ Write all queued events and stop the writer thread """
+        self._queue.put(None)
+        self._thread.join()
+        logger.info("Wrote node events to '%s'", self.filename)
@@ -17,6 +17,7 @@ import sys
 import logging
 import copy
 from anatools.lib.generator import ObjectGenerator
+from anatools.lib.load import load_first_datablock, copy_object
 import bpy
 
 logger = logging.getLogger(__name__)
@@ -37,17 +38,20 @@ def blender_load(self, **kwargs):
         return
 
     blender_file = kwargs.pop("blender_file")
-    # load the objects
-    with bpy.data.libraries.load(filepath="//" + blender_file, link=False) as (df, dt):
-        dt.objects = df.objects
-    
-    name = dt.objects[0].name
+    # load a copy of the first object in the file, only that object and the data it uses are appended
+    source = load_first_datablock(blender_file, "objects")
+    if source is None:
+        logger.critical(f"Blender file '{blender_file}' doesn't contain any objects")
+        raise ValueError
+    obj = copy_object(source, share_data=False)
+
+    name = obj.name
     self.collection = bpy.data.collections.new(name)
-    bpy.data.collections[name].objects.link(dt.objects[0])
+    self.collection.objects.link(obj)
     
     bpy.context.scene.collection.children.link(self.collection)
 
-    self.root = dt.objects[0]
+    self.root = obj
     self.loaded = True
     self.object_type = name
 
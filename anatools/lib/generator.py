@@ -15,10 +15,13 @@ from abc import ABC, abstractmethod
 import json
 import os
 import copy
+import operator
+import weakref
 import numpy as np
 import anatools.lib.context as ctx
 from anatools.lib.package_utils import get_volume_path
 from anatools.lib.ana_object import AnaObject
+from anatools.lib.load import request_datablock
 
 def get_blendfile_generator(package, object_class, object_type):
     """
@@ -39,8 +42,11 @@ class Generator(ABC):
     Base class for generators and modifiers
     """
     next_id = 0
-    # all generators indexed by id
-    generators = {}
+    # live generators indexed by id. Generators are only kept alive by the trees that use them.
+    generators = weakref.WeakValueDictionary()
+    # incremented whenever the weight of a generator changes, invalidating the cached weights of
+    # every parent
+    weights_version = 0
     def __init__(self, children=None, **kwargs):
         self.id = Generator.next_id
         Generator.generators[self.id] = self
@@ -50,7 +56,34 @@ class Generator(ABC):
         else:
             self.children = children
         self.kwargs = kwargs
-        self.weight = 1
+        self._weight = 1
+
+    @property
+    def weight(self):
+        """ Relative probability of this generator being selected by its parent """
+        return self._weight
+
+    @weight.setter
+    def weight(self, value):
+        if value != self._weight:
+            Generator.weights_version += 1
+        self._weight = value
+
+    @property
+    def children(self):
+        return self._children
+
+    @children.setter
+    def children(self, value):
+        self._children = value
+        self._cdf = None
+        self._cdf_version = None
+        self._cdf_children = None
+
+    @classmethod
+    def reset_registry(cls):
+        """ Forget the generators created by previous interpretations """
+        Generator.generators.clear()
 
     @abstractmethod
     def exec(self, *args, **kwargs):
@@ -68,14 +101,35 @@ class Generator(ABC):
         the_clone.children = []
         return the_clone
 
+    def _get_cdf(self):
+        """
+        Return the cumulative selection probabilities of the children. They are cached until the
+        weight of a generator changes or the children change. Children may be a list or a numpy
+        array that is changed in place, so the cached children are compared by identity.
+        """
+        children = self._children
+        cached = self._cdf_children
+        if self._cdf_version != Generator.weights_version or cached is None or \
+                len(cached) != len(children) or not all(map(operator.is_, cached, children)):
+            weights = np.array([child.weight for child in children])
+            # the same arithmetic as RandomState.choice so selections match previous releases
+            cdf = (weights/sum(weights)).cumsum()
+            cdf /= cdf[-1]
+            self._cdf = cdf
+            self._cdf_version = Generator.weights_version
+            self._cdf_children = list(children)
+        return self._cdf
+
     def select_child(self):
         """ Select a weighted random child """
-        weights = []
-        for child in self.children:
-            weights.append(child.weight)
-        weights = np.array(weights)
-        selected = ctx.random.choice(self.children, p=weights/sum(weights))
-        return selected
+        return self._children[self._get_cdf().searchsorted(ctx.random.random_sample(), side='right')]
+
+    def select_children(self, n):
+        """ Select n weighted random children, with replacement """
+        indices = self._get_cdf().searchsorted(ctx.random.random_sample(n), side='right')
+        return [self._children[i] for i in indices]
+
+ctx.add_reset_hook(Generator.reset_registry)
 
 class ObjectGenerator(Generator):
     """
@@ -160,70 +214,70 @@ class CreateBranchGenerator(Generator):
 
 class PathList(list):
     """
-    A list of paths. Each path is a list of generator id's from root to leaf
+    A list of paths. Each path is a list of generator id's from root to leaf. The generators
+    on the paths are recorded as they are visited so the paths don't depend on the registry.
     """
     def __init__(self, paths=None):
         if paths is None:
             super().__init__([])
         else:
             super().__init__(paths)
+        self.generators = {}
+
+    def add(self, path_index, generator):
+        """ Append a generator to a path """
+        self.generators[generator.id] = generator
+        self[path_index].append(generator.id)
+
+    def get_generator(self, gen_id):
+        """ Return the generator with the id """
+        generator = self.generators.get(gen_id)
+        if generator is None:
+            generator = Generator.generators[gen_id]
+        return generator
 
     def to_tree(self):
         """
         Convert a PathList into an executable tree
         """
         # clone the generators
-        new_generators = {}
-        id_map = {}
+        clones = {}
         new_children = {}
         for path in self:
             for gen_id in path:
-                if gen_id not in new_generators:
-                    clone = Generator.generators[gen_id].clone()
-                    new_generators[gen_id] = clone
-                    id_map[gen_id] = clone.id
-                    new_children[clone.id] = []
-        # create a map of the children
+                if gen_id not in clones:
+                    clones[gen_id] = self.get_generator(gen_id).clone()
+                    new_children[gen_id] = []
+        # create a map of the children. A child is added once for each path through it, so children
+        # on several paths are more likely to be selected.
         for path in self:
             if len(path) > 1:
                 for i in range(len(path[:-1])):
-                    clone_id = id_map[path[i]]
-                    clone_child_id = id_map[path[i+1]]
-                    if clone_child_id not in new_children[clone_id]:
-                        new_children[clone_id].append(Generator.generators[clone_child_id])
+                    new_children[path[i]].append(clones[path[i+1]])
         # update the children of the clones
-        for key, value in new_children.items():
-            Generator.generators[key].children = value
+        for gen_id, children in new_children.items():
+            clones[gen_id].children = children
 
-        tree = Generator.generators[id_map[self[0][0]]]
+        tree = clones[self[0][0]]
         return tree
 
-def _get_all_leaves(tree, leaf_class=ObjectGenerator, leaves=None):
-    """
-    Helper function that gets a list of all leaves in the tree. The list may include
-    dupes because it follows every possible path
-    """
-    if leaves is None:
-        leaves = []
-    if isinstance(tree, leaf_class):
-        leaves.append(tree)
-        return leaves
-    else:
-        for child in tree.children:
-            leaves = _get_all_leaves(child, leaf_class, leaves)
-        return leaves
-
 def get_unique_leaves(tree, leaf_class=ObjectGenerator):
     """
-    Get list of all unique leaves in the tree.
+    Get list of all unique leaves in the tree, in depth first order. Generators shared by
+    several branches are only visited once.
     """
-    leaves_with_dupes = _get_all_leaves(tree, leaf_class=leaf_class)
-    ids = []
+    visited = set()
     leaves = []
-    for leaf in leaves_with_dupes:
-        if leaf.id not in ids:
-            ids.append(leaf.id)
-            leaves.append(leaf)
+    stack = [tree]
+    while stack:
+        generator = stack.pop()
+        if generator.id in visited:
+            continue
+        visited.add(generator.id)
+        if isinstance(generator, leaf_class):
+            leaves.append(generator)
+        else:
+            stack.extend(reversed(generator.children))
     return leaves
 
 def _get_single_pathlist(tree, leaf_class=ObjectGenerator):
@@ -233,54 +287,94 @@ def _get_single_pathlist(tree, leaf_class=ObjectGenerator):
     """
     path = PathList([[]])
     while not isinstance(tree, leaf_class):
-        path[0].append(tree.id)
+        path.add(0, tree)
         tree = tree.select_child()
-    path[0].append(tree.id)
+    path.add(0, tree)
     return path
 
+def request_leaf(leaf):
+    """
+    Queue the collection of an object generator that uses the default loader, so it's appended
+    together with the other objects requested from the same blender file
+    """
+    if isinstance(leaf, ObjectGenerator) and "blender_file" in leaf.kwargs and \
+            getattr(leaf.object_class, "load", None) is AnaObject.load:
+        request_datablock(leaf.kwargs["blender_file"], "collections", leaf.object_type)
+
 def create_single_path(tree, leaf_class=ObjectGenerator):
     """
     Create an exectuable single path to a weighted random leaf.
+
+    The leaf's object is queued to be loaded with the next object loaded from the same blender
+    file. The queue only saves opening the file again if the node creates the paths for all of its
+    objects before executing any of them, e.g.
+
+        trees = [create_single_path(tree) for _ in range(number)]
+        objects = [tree.exec() for tree in trees]
     """
-    return _get_single_pathlist(tree, leaf_class=ObjectGenerator).to_tree()
+    path = _get_single_pathlist(tree, leaf_class=ObjectGenerator)
+    request_leaf(path.get_generator(path[0][-1]))
+    return path.to_tree()
 
-def _get_all_paths(tree, leaf_class=ObjectGenerator, paths=None, current_depth=0):
+def _count_routes_to_leaf(tree, leaf, leaf_class=ObjectGenerator):
     """
-    Helper function that creates a list of all paths in the tree
-    Returns a Pathlist with one entry per path
+    Helper function that counts the routes from each generator in the tree to the leaf. Returns
+    the counts indexed by generator id and the generators in topological order, parents before
+    children. Each generator is visited once, so shared branches don't multiply the work.
     """
-    if paths is None:
-        paths = PathList([[]])
-    current_depth += 1
-    paths[-1].append(tree.id)
-    if isinstance(tree, leaf_class):
-        # if we are at a leaf then we're done with this path
-        return paths
-    else:
-        # otherwise continue down the left-most path until we hit a leaf
-        paths = _get_all_paths(tree.children[0], leaf_class, paths, current_depth)
-        if len(tree.children) > 1:
-            # if there are more children then create new path
-            for child in tree.children[1:]:
-                paths.append(paths[-1][:current_depth])
-                paths = _get_all_paths(child, leaf_class, paths, current_depth)
-        return paths
+    # generator id -> number of routes to the leaf, None while its children are being visited
+    routes = {}
+    postorder = []
+    stack = [(tree, False)]
+    while stack:
+        generator, children_done = stack.pop()
+        if children_done:
+            routes[generator.id] = sum(routes[child.id] for child in generator.children)
+            postorder.append(generator)
+        elif generator.id in routes:
+            continue
+        elif isinstance(generator, leaf_class):
+            routes[generator.id] = 1 if generator is leaf else 0
+            postorder.append(generator)
+        else:
+            routes[generator.id] = None
+            stack.append((generator, True))
+            stack.extend((child, False) for child in reversed(generator.children) if child.id not in routes)
+    return routes, postorder[::-1]
 
 def create_multi_path(tree, leaf_class=ObjectGenerator):
     """
     Create an executable multi path to a weighted random leaf. Path includes all
     possible routes to the leaf.
+
+    A child appears in the children of its parent once for every route from the root to the leaf
+    that passes from the parent to the child, in the order the routes are found by a depth first
+    walk of the tree. Children that are on several routes are therefore more likely to be selected,
+    as they were when the tree was built from a list of every route.
+
+    The leaf's object is queued to be loaded, see create_single_path.
     """
-    # generate a pathlist
+    # pick the leaf
     single_path = _get_single_pathlist(tree, leaf_class)
-    # get the leaf
-    leaf_id = single_path[0][-1]
-    # generate all possible paths
-    all_paths = _get_all_paths(tree, leaf_class)
-    # save all paths that end at the leaf
-    paths_to_leaf = PathList()
-    for path in all_paths:
-        if path[-1] == leaf_id:
-            paths_to_leaf.append(path)
-    # convert back to a tree
-    return paths_to_leaf.to_tree()
+    leaf = single_path.get_generator(single_path[0][-1])
+    request_leaf(leaf)
+    # count the routes from the root to each generator and from each generator to the leaf
+    routes_to_leaf, generators = _count_routes_to_leaf(tree, leaf, leaf_class)
+    routes_from_root = {tree.id: 1}
+    for generator in generators:
+        if routes_to_leaf[generator.id] and not isinstance(generator, leaf_class):
+            for child in generator.children:
+                routes_from_root[child.id] = routes_from_root.get(child.id, 0) + routes_from_root[generator.id]
+    # clone the generators that lead to the leaf, keeping only children that lead to the leaf
+    clones = {}
+    for generator in generators:
+        if routes_to_leaf[generator.id]:
+            clones[generator.id] = generator.clone()
+    for generator in generators:
+        if routes_to_leaf[generator.id] and not isinstance(generator, leaf_class):
+            children = []
+            for child in generator.children:
+                if routes_to_leaf[child.id]:
+                    children.extend([clones[child.id]] * routes_to_leaf[child.id])
+            clones[generator.id].children = children * routes_from_root[generator.id]
+    return clones[tree.id]
@@ -11,19 +11,207 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import io
 import sys
+import copy
+import json
+import heapq
+import pickle
+import hashlib
 import logging
 import gc
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import anatools
 import anatools.lib.context as ctx
-from anatools.lib.node import create_node
+import anatools.lib.profiler as profiler
+import anatools.lib.events as events
+from anatools.lib.node import Node, create_node
+from anatools.lib.lru_cache import LRUCache
+from anatools.lib.disk_cache import read_cache, write_cache
+from anatools.lib.channel import load_yaml
 
 logger = logging.getLogger(__name__)
 
-def interp(graph):
-    """Interpret a graph"""
-    graphFormatVersion = graph.get("version", 0.0)
+# outputs of nodes whose schema sets 'pure: true', shared by all interpretations in the process
+pure_node_cache = LRUCache(maxsize=1024)
+
+# bump when the layout of execution plans changes so plans cached on disk are recompiled
+PLAN_VERSION = 3
+# execution plans compiled or loaded in this process, keyed by plan_key
+execution_plans = LRUCache(maxsize=64)
+
+def schema_output_ports(node):
+    """Return the set of output port names defined in the node schema"""
+    return {port_dict["name"] for port_dict in (node.schema["outputs"] or [])}
+
+def check_outputs(node, outputs, ports):
+    """Verify the actual node output matches the schema outputs"""
+    # TODO: After people clean up their returns, make this throw an exception.
+    if set(outputs.keys()) != ports:
+        logger.error("Output returned by node '%s' class '%s' doesn't match output defined in schema",
+                    node.name, node.__class__.__name__)
+
+def pure_node_key(node):
+    """Return a key for the node class and its resolved inputs, or None if the inputs can't be hashed"""
+    data = io.BytesIO()
+    pickler = pickle.Pickler(data, protocol=4)
+    # don't memoize shared objects so equal inputs always give the same key
+    pickler.fast = True
+    try:
+        pickler.dump((node.__class__.__module__, node.__class__.__qualname__, sorted(node.inputs.items())))
+    except Exception:
+        return None
+    return hashlib.sha256(data.getvalue()).hexdigest()
+
+def run_node(node):
+    """Call the node's exec method, drawing ctx.random from the node's own stream in 'streams' rng mode"""
+    if ctx.rng_mode == "streams":
+        with ctx.node_stream(node.name):
+            return record_node(node)
+    return record_node(node)
+
+def record_node(node, execute=None, status="ok"):
+    """
+    Call the node's exec method, or execute(node) if given, recording node events if the event
+    stream is on. status is the status of the event when the call succeeds.
+    """
+    if events.active_stream is not None:
+        return events.active_stream.record_node(node, lambda node: profile_node(node, execute, status), status)
+    return profile_node(node, execute, status)
+
+def profile_node(node, execute=None, status="ok"):
+    """Call the node's exec method, or execute(node) if given, recording a profile if profiling is on"""
+    if profiler.active_profiler is not None:
+        return profiler.active_profiler.profile_node(node, execute, status)
+    if execute is not None:
+        return execute(node)
+    return node.exec()
+
+def execute_node(node):
+    """
+    Execute a node. A pure node's outputs depend only on its inputs, so they are cached and
+    reused when a node of the same class is executed again with the same inputs. Callers get
+    their own copy of cached outputs so downstream nodes can't modify the cache. Reusing cached
+    outputs is recorded in the event stream and profile with the status 'cached'.
+    """
+    if not node.schema.get("pure", False) or len(node.lazy_inputs) > 0:
+        return run_node(node)
+    key = pure_node_key(node)
+    if key is None:
+        return run_node(node)
+    outputs = pure_node_cache.get(key)
+    if outputs is None:
+        outputs = run_node(node)
+        pure_node_cache.put(key, copy.deepcopy(outputs))
+        return outputs
+    logger.debug("Using cached outputs for node '%s' class '%s'", node.name, node.__class__.__name__)
+    return record_node(node, lambda node: copy.deepcopy(outputs), "cached")
+
+def release_node(node):
+    """
+    Drop a finished node's references to its inputs. Objects returned by a node may keep the node
+    alive, e.g. a bound method, and this stops them from also keeping every input value alive.
+    Nodes must not read self.inputs after exec returns.
+    """
+    node.inputs = {}
+
+class DeferredNode:
+    """A node that is executed the first time one of its outputs is requested through a LazyInput"""
+
+    def __init__(self, node, output_ports):
+        self.node = node
+        self.output_ports = output_ports
+        self.outputs = None
+
+    def get_outputs(self):
+        """Execute the node if it hasn't been executed yet and return its outputs"""
+        if self.outputs is None:
+            node = self.node
+            # inputs from other deferred nodes are resolved now, except on the node's own lazy inputs
+            for port, values in node.inputs.items():
+                if port not in node.lazy_inputs:
+                    node.inputs[port] = [value() if isinstance(value, LazyInput) else value for value in values]
+            logger.info("Executing deferred node '%s' class '%s'", node.name, node.__class__.__name__)
+            self.outputs = execute_node(node)
+            check_outputs(node, self.outputs, self.output_ports)
+            release_node(node)
+            self.node = None
+        return self.outputs
+
+class LazyInput:
+    """
+    A value passed to an input port whose schema sets 'lazy: true'. Call it to get the value. If
+    the value comes from a node that only feeds lazy inputs then that node, and any such nodes it
+    depends on, are executed when the value is first requested. A node that never calls its lazy
+    input never causes the upstream branch to execute, e.g.
+
+        value = self.inputs["True"][0]() if condition else self.inputs["False"][0]()
+    """
 
-    # create and configure nodes
+    def __init__(self, deferred_node=None, port=None, value=None):
+        self.deferred_node = deferred_node
+        self.port = port
+        self.value = value
+
+    def __call__(self):
+        if self.deferred_node is None:
+            return self.value
+        return self.deferred_node.get_outputs()[self.port]
+
+def deferred_nodes(nodes):
+    """
+    Return the names of nodes whose outputs only feed lazy inputs, directly or through other
+    deferred nodes. Nodes without outlinks are always executed.
+    """
+    eager = {name for name, node in nodes.items() if len(node.outlinks) == 0}
+    stack = list(eager)
+    while stack:
+        node = nodes[stack.pop()]
+        for port, links in node.inlinks.items():
+            if port in node.lazy_inputs:
+                continue
+            for src_node, _ in links:
+                if src_node not in eager:
+                    eager.add(src_node)
+                    stack.append(src_node)
+    return set(nodes) - eager
+
+def prune_nodes(nodes, output_ports):
+    """
+    Remove nodes that don't contribute to a sink. Sinks are nodes without outputs and nodes whose
+    schema sets 'terminal: true'. Every node that a sink depends on, directly or indirectly, is kept.
+    """
+    sinks = [name for name, node in nodes.items()
+             if len(output_ports[node.alias]) == 0 or node.schema.get("terminal", False)]
+    if len(sinks) == 0:
+        logger.warning("Graph has no sink nodes; nothing will be executed")
+
+    # walk the inlinks backwards from the sinks
+    live = set(sinks)
+    stack = list(sinks)
+    while stack:
+        node = nodes[stack.pop()]
+        for links in node.inlinks.values():
+            for src_node, _ in links:
+                if src_node not in live:
+                    live.add(src_node)
+                    stack.append(src_node)
+
+    for name in [name for name in nodes if name not in live]:
+        logger.info("Skipping node '%s' class '%s', its outputs are not used",
+                    name, nodes[name].__class__.__name__)
+        del nodes[name]
+
+    # drop the outlinks of live nodes that fed the pruned nodes
+    for node in nodes.values():
+        for src_port in list(node.outlinks):
+            node.outlinks[src_port] = [link for link in node.outlinks[src_port] if link[0] in live]
+            if len(node.outlinks[src_port]) == 0:
+                del node.outlinks[src_port]
+
+def configure_nodes(graph):
+    """Create and configure the nodes in a graph, sorted by name"""
+    graphFormatVersion = graph.get("version", 0.0)
     nodes = {}
     for name, node_config in sorted(graph["nodes"].items()):
         if graphFormatVersion == 0.0:
@@ -32,23 +220,22 @@ def interp(graph):
         else:
             nodes[name] = create_node(name, node_config["nodeClass"])
             nodes[name].configure(node_config)
+    return nodes
 
-    # append outlinks to nodes
+def link_nodes(nodes, output_ports):
+    """Validate the inlinks of each node and append the matching outlinks to the source nodes"""
     for dst_node in nodes:
         for dst_port in nodes[dst_node].inlinks:
             for link in nodes[dst_node].inlinks[dst_port]:
                 src_node, src_port = link
-                if src_node in nodes.keys():
-                    schema_output_set = set()
-                    for port_dict in nodes[src_node].schema["outputs"]:
-                        schema_output_set.add(port_dict["name"])
-                    if src_port not in schema_output_set:
+                if src_node in nodes:
+                    if src_port not in output_ports[nodes[src_node].alias]:
                         logger.error(
                             "Node '%s' class '%s' input '%s' is linked to node '%s' class '%s' on undefined port '%s'",
                             dst_node, nodes[dst_node].__class__.__name__, dst_port,
-                            src_node, nodes[src_port].__class__.__name__, src_port)
+                            src_node, nodes[src_node].__class__.__name__, src_port)
                         sys.exit(1)
-                    if src_port not in nodes[src_node].outlinks.keys():
+                    if src_port not in nodes[src_node].outlinks:
                         nodes[src_node].outlinks[src_port] = []
                     nodes[src_node].outlinks[src_port].append((dst_node, dst_port))
                 else:
@@ -57,59 +244,315 @@ def interp(graph):
                         dst_node, nodes[dst_node].__class__.__name__, dst_port, src_node)
                     sys.exit(1)
 
+def order_inlinks(nodes):
+    """
+    Sort the inlinks of each input port in the order a serial run resolves them. The serial run
+    executes nodes from a ready queue keyed by their position in the sorted node list, so values
+    on a port fed by several links arrive in the execution order of their source nodes. Keeping
+    that order for threaded runs too means node inputs don't depend on the thread count.
+    """
+    indegree = {name: sum(len(links) for links in node.inlinks.values()) for name, node in nodes.items()}
+    order = {name: i for i, name in enumerate(nodes)}
+    ready = [(order[name], name) for name in nodes if indegree[name] == 0]
+    heapq.heapify(ready)
+
+    # simulate the serial schedule and number the links in the order they are resolved
+    arrival = {}
+    while ready:
+        _, name = heapq.heappop(ready)
+        for src_port, outlinks in nodes[name].outlinks.items():
+            for dst_node, dst_port in outlinks:
+                arrival.setdefault((dst_node, dst_port, name, src_port), len(arrival))
+                indegree[dst_node] -= 1
+                if indegree[dst_node] == 0:
+                    heapq.heappush(ready, (order[dst_node], dst_node))
+
+    # links that are never resolved are left at the end, execute_nodes reports them
+    for dst_node, node in nodes.items():
+        for dst_port, links in node.inlinks.items():
+            links.sort(key=lambda link: arrival.get((dst_node, dst_port) + tuple(link), len(arrival)))
+
+def plan_key(graph_data, prune=False):
+    """
+    Return the key of the execution plan for a graph on the current channel. graph_data is either
+    the contents of the graph file or the parsed graph.
+    """
+    if not isinstance(graph_data, bytes):
+        graph_data = json.dumps(graph_data, sort_keys=True, default=str).encode()
+    header = json.dumps([PLAN_VERSION, anatools.__version__, ctx.channel.schema_hash(), prune]).encode()
+    return hashlib.sha256(header + graph_data).hexdigest()
+
+def get_cached_plan(key):
+    """Return the execution plan cached in this process or on disk, or None"""
+    plan = execution_plans.get(key)
+    if plan is None:
+        plan = read_cache("plans", key)
+        if plan is not None:
+            execution_plans.put(key, plan)
+    if plan is not None:
+        logger.debug("Using cached execution plan '%s'", key)
+    return plan
+
+def cache_plan(key, plan):
+    """Cache an execution plan in this process and on disk"""
+    execution_plans.put(key, plan)
+    write_cache("plans", key, plan)
+
+def compile_nodes(graph, prune=False):
+    """
+    Compile a graph into an execution plan. Returns the plan and the configured nodes so the
+    caller can execute them without instantiating the plan.
+
+    The plan is a dictionary of plain data that can be pickled:
+
+        {
+            "graph_version": 1.0,
+            "nodes": [
+                {
+                    "name": "node1",
+                    "alias": "NodeClass",
+                    "inputs": {"inport1": [val1, ...]},
+                    "inlinks": {"inport2": [(src_index, "src_port"), ...]},
+                    "outlinks": {"outport1": [(dst_index, "dst_port"), ...]},
+                    "config": {"nodeClass": "NodeClass", ...}
+                },
+                ...
+            ],
+            "deferred": ["node2", ...],
+            "output_ports": {"NodeClass": ["outport1", ...]}
+        }
+
+    Links refer to nodes by their index in the plan, which is also their execution priority. The
+    inlinks of each port are in the order a serial run resolves them, see order_inlinks.
+    Each node keeps its graph config so nodes whose class overrides configure can re-run it for
+    each instance. Whether the class overrides configure is checked when the plan is instantiated
+    because the plan doesn't change when the node package code does.
+    """
+    graphFormatVersion = graph.get("version", 0.0)
+    nodes = configure_nodes(graph)
+
+    # output ports only depend on the schema so compute them once per class
+    output_ports = {}
+    for node in nodes.values():
+        if node.alias not in output_ports:
+            output_ports[node.alias] = schema_output_ports(node)
+
+    link_nodes(nodes, output_ports)
+    if prune:
+        prune_nodes(nodes, output_ports)
+    order_inlinks(nodes)
+
+    index = {name: i for i, name in enumerate(nodes)}
+    plan_nodes = []
+    for name, node in nodes.items():
+        plan_nodes.append({
+            "name": name,
+            "alias": node.alias,
+            "inputs": copy.deepcopy(node.inputs),
+            "inlinks": {port: [(index[src], src_port) for src, src_port in links] for port, links in node.inlinks.items()},
+            "outlinks": {port: [(index[dst], dst_port) for dst, dst_port in links] for port, links in node.outlinks.items()},
+            "config": graph["nodes"][name]
+        })
+    plan = {
+        "graph_version": graphFormatVersion,
+        "nodes": plan_nodes,
+        "deferred": sorted(deferred_nodes(nodes)),
+        "output_ports": {alias: sorted(ports) for alias, ports in output_ports.items()}
+    }
+    return plan, nodes
+
+def compile_graph(graph, prune=False):
+    """Compile a graph into an execution plan for the current channel, see compile_nodes"""
+    plan, _ = compile_nodes(graph, prune)
+    return plan
+
+def instantiate_plan(plan):
+    """Create the nodes of an execution plan, ready to execute"""
+    names = [plan_node["name"] for plan_node in plan["nodes"]]
+    nodes = {}
+    for plan_node in plan["nodes"]:
+        node = create_node(plan_node["name"], plan_node["alias"])
+        # if the node class has its own configure then let it set up its state
+        if plan["graph_version"] == 0.0:
+            if type(node).configure_v0 is not Node.configure_v0:
+                node.configure_v0(plan_node["config"])
+        elif type(node).configure is not Node.configure:
+            node.configure(plan_node["config"])
+        node.inputs = copy.deepcopy(plan_node["inputs"])
+        node.inlinks = {port: [(names[src], src_port) for src, src_port in links] for port, links in plan_node["inlinks"].items()}
+        node.outlinks = {port: [(names[dst], dst_port) for dst, dst_port in links] for port, links in plan_node["outlinks"].items()}
+        nodes[node.name] = node
+    return nodes
+
+def load_plan(graph_file, prune=False):
+    """
+    Return the execution plan for a graph file. The file is only parsed and compiled if the same
+    file contents haven't been compiled before for the same channel schemas.
+    """
+    with open(graph_file, "rb") as f:
+        graph_data = f.read()
+    key = plan_key(graph_data, prune)
+    plan = get_cached_plan(key)
+    if plan is None:
+        plan = compile_graph(load_yaml(graph_data), prune)
+        cache_plan(key, plan)
+    return plan
+
+def interp(graph, threads=0, prune=False):
+    """
+    Interpret a graph
+
+    The graph is compiled into an execution plan that is cached in memory and on disk, so
+    interpreting the same graph again skips configuring, validating and linking the nodes.
+    See execute_nodes for the other arguments.
+    """
+    ctx.reset()
+    key = plan_key(graph, prune)
+    plan = get_cached_plan(key)
+    if plan is None:
+        plan, nodes = compile_nodes(graph, prune)
+        cache_plan(key, plan)
+    else:
+        nodes = instantiate_plan(plan)
+    execute_nodes(plan, nodes, threads)
+
+def interp_plan(plan, threads=0):
+    """Interpret a compiled execution plan, see compile_graph and load_plan"""
+    ctx.reset()
+    execute_nodes(plan, instantiate_plan(plan), threads)
+
+def execute_nodes(plan, nodes, threads=0):
+    """
+    Execute the nodes of an execution plan
+
+    If the plan was compiled with prune set then only nodes that a sink depends on are present,
+    see prune_nodes.
+
+    Nodes that only feed input ports whose schema sets 'lazy: true' are executed on demand when
+    the consuming node calls the LazyInput it receives on that port, see LazyInput.
+
+    If threads is greater than zero then nodes whose schema sets 'threadsafe: true' are executed
+    on a pool of that many threads while the remaining nodes execute on the calling thread. Nodes
+    that touch Blender data must not be marked threadsafe.
+
+    When several links feed the same input port the values are passed in the order of the links.
+    The plan sorts them in the order a serial run executes their source nodes, see order_inlinks,
+    so node inputs don't depend on the order in which the source nodes finish.
+    """
+    output_ports = {alias: set(ports) for alias, ports in plan["output_ports"].items()}
+
+    # configured values on lazy inputs are passed as callables like linked values
+    for node in nodes.values():
+        for port in node.lazy_inputs & set(node.inputs):
+            node.inputs[port] = [LazyInput(value=value) for value in node.inputs[port]]
+
+    # nodes that are only executed when a lazy input asks for their value
+    deferred = set(plan["deferred"])
+
+    # count the unresolved inlinks of each node
+    indegree = {name: sum(len(links) for links in node.inlinks.values()) for name, node in nodes.items()}
+
+    # linked values are held in one slot per inlink and passed to the node once every slot is filled
+    link_slots = {name: {port: list(links) for port, links in node.inlinks.items()} for name, node in nodes.items()}
+    link_values = {name: {port: [None] * len(links) for port, links in node.inlinks.items()} for name, node in nodes.items()}
+
+    # ready queue of nodes with all input links resolved. Nodes are keyed by their position in
+    # the sorted node list so the execution order is the same as a linear scan of the graph.
+    order = {name: i for i, name in enumerate(nodes)}
+    ready = [(order[name], name) for name in nodes if indegree[name] == 0]
+    heapq.heapify(ready)
+
+    def resolve_outputs(node, outputs):
+        """Pass node outputs to downstream nodes and queue the ones that become ready"""
+        name = node.name
+        # resolve output links
+        for src_port in node.outlinks:
+            for outlink in node.outlinks[src_port]:
+                dst_node, dst_port = outlink
+                value = outputs[src_port]
+                if dst_port in nodes[dst_node].lazy_inputs and not isinstance(value, LazyInput):
+                    value = LazyInput(value=value)
+                # remove inlink from destination node/port and fill its slot
+                try:
+                    slot = link_slots[dst_node][dst_port].index((name, src_port))
+                    link_slots[dst_node][dst_port][slot] = None
+                    link_values[dst_node][dst_port][slot] = value
+                    nodes[dst_node].inlinks[dst_port].remove((name, src_port))
+                    # if there are no more inlinks on the destination port then delete it
+                    if len(nodes[dst_node].inlinks[dst_port]) == 0:
+                        del nodes[dst_node].inlinks[dst_port]
+                except (KeyError, ValueError):
+                    # this is a coding error
+                    logger.critical(
+                        "Node '%s' class '%s' is missing link '[%s, %s]'",
+                        dst_node, nodes[dst_node].__class__.__name__, name, src_port)
+                    sys.exit(1)
+                # if all input links have been resolved then append the linked values to the
+                # inputs of the destination node and it is ready
+                indegree[dst_node] -= 1
+                if indegree[dst_node] == 0:
+                    del link_slots[dst_node]
+                    for port, values in link_values.pop(dst_node).items():
+                        if port not in nodes[dst_node].inputs:
+                            nodes[dst_node].inputs[port] = []
+                        nodes[dst_node].inputs[port].extend(values)
+                    heapq.heappush(ready, (order[dst_node], dst_node))
+
+    def finish_node(node, outputs):
+        """Pass the outputs of an executed node downstream and release its inputs"""
+        check_outputs(node, outputs, output_ports[node.alias])
+        resolve_outputs(node, outputs)
+        release_node(node)
+
+    def resolve_finished(futures, timeout=None):
+        """Resolve outputs of pool nodes that have finished, in graph order"""
+        done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in sorted(done, key=lambda f: order[futures[f].name]):
+            finish_node(futures.pop(future), future.result())
+
     # execute nodes
-    while len(nodes) > 0:
-        node_executed = None
-        for name, node in nodes.items():
-            # if all input links have been resolved then execute this node
-            if len(node.inlinks.keys()) == 0:
-                logger.info("Executing node '%s' class '%s'", name, node.__class__.__name__)
-                outputs = node.exec()
-                # verify the actual node output matches the schema outputs
-                # TODO: After people clean up their returns, make this throw an exception.
-                schema_output_set = set()
-                for port_dict in node.schema["outputs"]:
-                    schema_output_set.add(port_dict["name"])
-                if set(outputs.keys()) != schema_output_set:
-                    logger.error("Output returned by node '%s' class '%s' doesn't match output defined in schema",
-                                node.name, node.__class__.__name__)
-                # resolve output links
-                for src_port in node.outlinks:
-                    for outlink in node.outlinks[src_port]:
-                        dst_node, dst_port = outlink
-                        # append value to input of destination node/port
-                        if dst_port not in nodes[dst_node].inputs.keys():
-                            nodes[dst_node].inputs[dst_port] = []
-                        nodes[dst_node].inputs[dst_port].append(outputs[src_port])
-                        # remove inlink from destination node/port
-                        try:
-                            nodes[dst_node].inlinks[dst_port].remove((name, src_port))
-                            # if there are no more inlinks on the destination port then delete it
-                            if len(nodes[dst_node].inlinks[dst_port]) == 0:
-                                del nodes[dst_node].inlinks[dst_port]
-                        except ValueError:
-                            # this is a coding error
-                            logger.critical(
-                                "Node '%s' class '%s' is missing link '[%s, %s]'",
-                                dst_node, nodes[dst_node].__class__.__name__, name, src_port)
-                            sys.exit(1)
-                node_executed = node
-                break
-
-        # delete the node we executed
-        if node_executed:
-            del nodes[node_executed.name]
-        else:
-            # this is either a coding error or a cycle in the graph
-            errorString = "Graph execution failed; graph may be cyclic. The following links could not be resolved: "
-            linkDescriptions = []
-            for name in nodes:
-                for port in nodes[name].inlinks:
-                    for inlink in nodes[name].inlinks[port]:
-                        linkDescriptions.append("Node '%s' class '%s' input '%s' link '[%s, %s]'",
-                                                name, nodes[name].__class__.__name__, port, inlink[0], inlink[1])
-            errorString += ', '.join(linkDescriptions)
-            logger.error(errorString)
-            sys.exit(1)
+    executor = ThreadPoolExecutor(max_workers=threads) if threads > 0 else None
+    futures = {}
+    try:
+        while ready or futures:
+            if not ready:
+                # everything that can run is on the pool so wait for a node to finish
+                resolve_finished(futures)
+                continue
+            _, name = heapq.heappop(ready)
+            node = nodes.pop(name)
+            if name in deferred:
+                # pass on callables that execute the node when a lazy input asks for its value
+                deferred_node = DeferredNode(node, output_ports[node.alias])
+                resolve_outputs(node, {port: LazyInput(deferred_node, port) for port in output_ports[node.alias]})
+                del node, deferred_node
+                continue
+            logger.info("Executing node '%s' class '%s'", name, node.__class__.__name__)
+            # nodes with lazy inputs may execute deferred nodes so they stay on this thread
+            if executor is not None and node.schema.get("threadsafe", False) and len(node.lazy_inputs) == 0:
+                futures[executor.submit(execute_node, node)] = node
+            else:
+                finish_node(node, execute_node(node))
+            # the only references to the node and its outputs are now held by its consumers
+            del node
+            if futures:
+                # pick up pool results without blocking so their consumers can be queued
+                resolve_finished(futures, timeout=0)
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    if len(nodes) > 0:
+        # this is either a coding error or a cycle in the graph
+        errorString = "Graph execution failed; graph may be cyclic. The following links could not be resolved: "
+        linkDescriptions = []
+        for name in nodes:
+            for port in nodes[name].inlinks:
+                for inlink in nodes[name].inlinks[port]:
+                    linkDescriptions.append("Node '{}' class '{}' input '{}' link '[{}, {}]'".format(
+                        name, nodes[name].__class__.__name__, port, inlink[0], inlink[1]))
+        errorString += ', '.join(linkDescriptions)
+        logger.error(errorString)
+        sys.exit(1)
 
     gc.collect()
\ No newline at end of file
@@ -13,9 +13,316 @@
 # limitations under the License.
 """ 
 A collection of utility functions that load assets from existing blender files 
+
+Datablocks appended from a file are kept in a process-wide cache and every load hands out a
+copy, so a file is only opened the first time a datablock is requested from it. The cache is
+bounded by the estimated memory of the cached datablocks, set in megabytes with the
+ANA_LIBRARY_CACHE_MB environment variable (default 2048), and is kept across interpretations so
+batch runs only append each datablock once. It is cleared when a new main file is opened, which
+frees the sources. Datablocks queued with request_datablock are dropped before each interpretation.
+
+Datablocks that will be needed later can be queued with request_datablock. The next time a file
+is opened every datablock queued for it is appended in the same open.
 """
+import os
 import bpy
+from bpy.app.handlers import persistent
+import anatools.lib.context as ctx
 from anatools.lib.search_utils import find_root
+from anatools.lib.lru_cache import LRUCache
+
+
+def estimate_datablock_size(datablock, seen=None):
+    """ Roughly estimate the memory used by a datablock and the datablocks it uses, in bytes """
+    if seen is None:
+        seen = set()
+    key = (type(datablock).__name__, datablock.name)
+    if key in seen:
+        return 0
+    seen.add(key)
+    size = 1024
+    if isinstance(datablock, bpy.types.Collection):
+        for obj in datablock.all_objects:
+            size += estimate_datablock_size(obj, seen)
+    elif isinstance(datablock, bpy.types.Object):
+        if datablock.data is not None:
+            size += estimate_datablock_size(datablock.data, seen)
+        for slot in datablock.material_slots:
+            if slot.material is not None:
+                size += estimate_datablock_size(slot.material, seen)
+    elif isinstance(datablock, bpy.types.Mesh):
+        size += 64 * (len(datablock.vertices) + len(datablock.edges) + len(datablock.loops) + len(datablock.polygons))
+    elif isinstance(datablock, bpy.types.Material):
+        if datablock.node_tree is not None:
+            for node in datablock.node_tree.nodes:
+                if getattr(node, "image", None) is not None:
+                    size += estimate_datablock_size(node.image, seen)
+    elif isinstance(datablock, bpy.types.Image):
+        width, height = datablock.size
+        size += width * height * datablock.channels * (4 if datablock.is_float else 1)
+    elif isinstance(datablock, bpy.types.Text):
+        size += len(datablock.as_string())
+    return size
+
+
+def remove_datablock(key, datablock):
+    """ Remove an evicted source datablock. Data it shared with copies is kept by the copies. """
+    try:
+        if isinstance(datablock, bpy.types.Collection):
+            bpy.data.batch_remove([datablock] + list(datablock.all_objects))
+        else:
+            getattr(bpy.data, key[1]).remove(datablock)
+    except ReferenceError:
+        # the datablock was already freed, e.g. when a new file was opened
+        pass
+
+
+# cached sources are renamed so copies get the names the datablocks have in the blender file. Object
+# data and materials keep their names while instanced copies share them with the source, and are
+# renamed when they are copied so the copy gets the name instead, see copy_data and share_source_data.
+SOURCE_PREFIX = "ana_source."
+
+def mark_source(datablock, seen=None):
+    """ Rename a source datablock, and the collections and objects of a source collection """
+    if seen is None:
+        seen = set()
+    if datablock.as_pointer() in seen:
+        return
+    seen.add(datablock.as_pointer())
+    datablock.name = SOURCE_PREFIX + datablock.name
+    if isinstance(datablock, bpy.types.Collection):
+        for child in datablock.children:
+            mark_source(child, seen)
+        for obj in datablock.all_objects:
+            mark_source(obj, seen)
+
+def original_name(name):
+    """ Return the name a source datablock has in the blender file """
+    return name[len(SOURCE_PREFIX):] if name.startswith(SOURCE_PREFIX) else name
+
+def copy_source(datablock):
+    """ Copy a source datablock, giving the copy the name it has in the blender file """
+    datablock_copy = datablock.copy()
+    datablock_copy.name = original_name(datablock.name)
+    return datablock_copy
+
+def copy_data(datablock):
+    """
+    Copy the object data or material of a source object. The source is renamed first so the copy
+    gets the name the datablock has in the blender file.
+    """
+    if not datablock.name.startswith(SOURCE_PREFIX):
+        datablock.name = SOURCE_PREFIX + datablock.name
+    return copy_source(datablock)
+
+def share_source_data(datablock):
+    """ Give object data or a material that copies share with the source its name from the blender file """
+    if datablock.name.startswith(SOURCE_PREFIX):
+        datablock.name = original_name(datablock.name)
+    return datablock
+
+# source datablocks appended from blender files indexed by (blender file, datablock type, name). The
+# sources are never linked to a scene, callers get copies of them.
+library_cache = LRUCache(
+    maxsize=4096,
+    maxweight=int(os.environ.get("ANA_LIBRARY_CACHE_MB", 2048)) * 1024 * 1024,
+    weigh=estimate_datablock_size,
+    on_evict=remove_datablock)
+# (datablock type, name) requests that haven't been appended yet, indexed by blender file
+pending_requests = {}
+# name of the first datablock of a type in a blender file, indexed by (blender file, datablock type)
+first_datablock_names = {}
+
+@persistent
+def reset_library_cache(*args):
+    """ Forget the cached sources and queued requests when a new main file is opened and frees them """
+    library_cache.clear()
+    pending_requests.clear()
+    first_datablock_names.clear()
+
+if reset_library_cache not in bpy.app.handlers.load_post:
+    bpy.app.handlers.load_post.append(reset_library_cache)
+
+def cached_sources():
+    """ Return the cached source datablocks that haven't been freed """
+    sources = []
+    for datablock in library_cache.values():
+        try:
+            datablock.name
+        except ReferenceError:
+            continue
+        sources.append(datablock)
+    return sources
+
+ctx.add_reset_hook(pending_requests.clear)
+
+
+def request_datablock(blender_file_name, datablock_type, name):
+    """ Queue a datablock to be appended with the next datablock loaded from the same file """
+    if (blender_file_name, datablock_type, name) not in library_cache:
+        pending_requests.setdefault(blender_file_name, {})[(datablock_type, name)] = None
+
+
+def append_datablocks(blender_file_name, requests):
+    """
+    Append datablocks from a blender file with a single open and cache them. requests is a list of
+    (datablock type, name). Returns a dictionary mapping each request to its datablock, which is
+    None if it couldn't be appended.
+    """
+    names = {}
+    for datablock_type, name in requests:
+        names.setdefault(datablock_type, []).append(name)
+    with bpy.data.libraries.load(filepath="//" + blender_file_name, link=False) as (_, dt):
+        for datablock_type, type_names in names.items():
+            setattr(dt, datablock_type, list(type_names))
+    datablocks = {}
+    for datablock_type, type_names in names.items():
+        for name, datablock in zip(type_names, getattr(dt, datablock_type)):
+            datablocks[(datablock_type, name)] = datablock
+    # cache the datablocks in request order so the first request is evicted last
+    for request in reversed(requests):
+        datablock = datablocks[request]
+        if datablock is not None:
+            mark_source(datablock)
+            library_cache.put((blender_file_name,) + request, datablock)
+    return datablocks
+
+
+def load_datablock(blender_file_name, datablock_type, name):
+    """
+    Return the source datablock of the given type, e.g. "collections" or "materials", appending it
+    from the blender file if it isn't cached. The source must not be modified or linked to a scene,
+    use copy_source or copy_collection to get a copy of it.
+    """
+    key = (blender_file_name, datablock_type, name)
+    datablock = library_cache.get(key)
+    if datablock is not None:
+        try:
+            datablock.name
+            return datablock
+        except ReferenceError:
+            # the datablock was freed when a new file was opened
+            pass
+    # append the datablocks queued for the file at the same time
+    requests = [(datablock_type, name)]
+    for request in pending_requests.pop(blender_file_name, {}):
+        if request not in requests and (blender_file_name,) + request not in library_cache:
+            requests.append(request)
+    return append_datablocks(blender_file_name, requests)[(datablock_type, name)]
+
+
+def load_first_datablock(blender_file_name, datablock_type):
+    """
+    Return the source of the first datablock of the given type in the blender file, or None if the
+    file has none. Only that datablock and the data it uses are appended.
+    """
+    name = first_datablock_names.get((blender_file_name, datablock_type))
+    if name is not None:
+        return load_datablock(blender_file_name, datablock_type, name)
+    # pick the name from the library listing and append it with the same open
+    with bpy.data.libraries.load(filepath="//" + blender_file_name, link=False) as (df, dt):
+        names = list(getattr(df, datablock_type))
+        setattr(dt, datablock_type, names[:1])
+    if len(names) == 0:
+        return None
+    datablock = getattr(dt, datablock_type)[0]
+    if datablock is not None:
+        mark_source(datablock)
+        library_cache.put((blender_file_name, datablock_type, names[0]), datablock)
+        first_datablock_names[(blender_file_name, datablock_type)] = names[0]
+    return datablock
+
+
+def copy_object(source, share_data=True, materials=None):
+    """
+    Copy an object. If share_data is false the object data and materials are copied too, with
+    materials already copied for other objects of the same asset taken from materials. Either
+    way the data and materials used by the copy have the names they have in the blender file.
+    """
+    obj_copy = copy_source(source)
+    if share_data:
+        if source.data is not None:
+            share_source_data(source.data)
+        for slot in obj_copy.material_slots:
+            if slot.material is not None:
+                share_source_data(slot.material)
+    else:
+        if materials is None:
+            materials = {}
+        if source.data is not None:
+            obj_copy.data = copy_data(source.data)
+        for slot in obj_copy.material_slots:
+            if slot.material is not None:
+                # copying renames the source material so key the copies by the source itself
+                key = slot.material.as_pointer()
+                if key not in materials:
+                    materials[key] = copy_data(slot.material)
+                slot.material = materials[key]
+    return obj_copy
+
+
+def remap_object_references(item, copies):
+    """ Point the object properties of a modifier, constraint or driver target at the copies """
+    for prop in item.bl_rna.properties:
+        if prop.type != "POINTER" or prop.is_readonly or prop.fixed_type.identifier not in ("Object", "ID"):
+            continue
+        value = getattr(item, prop.identifier)
+        if isinstance(value, bpy.types.Object) and value.name in copies:
+            setattr(item, prop.identifier, copies[value.name])
+
+
+def remap_references(obj_copy, copies):
+    """
+    Remap the references of a copied object to other objects of the source to their copies. This
+    covers modifiers, object and bone constraints, and driver variables.
+    """
+    items = list(obj_copy.modifiers) + list(obj_copy.constraints)
+    if obj_copy.pose is not None:
+        for bone in obj_copy.pose.bones:
+            items.extend(bone.constraints)
+    for constraint in list(items):
+        # e.g. the targets of an armature constraint
+        items.extend(getattr(constraint, "targets", []))
+    if obj_copy.animation_data is not None:
+        for fcurve in obj_copy.animation_data.drivers:
+            for variable in fcurve.driver.variables:
+                items.extend(variable.targets)
+    for item in items:
+        remap_object_references(item, copies)
+
+
+def copy_collection(source, share_data=True, copies=None, materials=None):
+    """
+    Create a copy of a collection and the objects in it. Parents, modifier and constraint targets
+    and driver targets that refer to objects of the source are remapped to the copies.
+    If share_data is true the copied objects share mesh, material and other object data with the
+    originals, otherwise the object data and materials are copied too. Images are always shared.
+    """
+    top_level = copies is None
+    if top_level:
+        copies = {}
+        materials = {}
+    # copy the collection to keep its settings, e.g. hide_render, and link the copied objects
+    collection = copy_source(source)
+    for obj in list(collection.objects):
+        collection.objects.unlink(obj)
+    for child in list(collection.children):
+        collection.children.unlink(child)
+    for obj in source.objects:
+        if obj.name not in copies:
+            copies[obj.name] = copy_object(obj, share_data, materials)
+        collection.objects.link(copies[obj.name])
+    for child in source.children:
+        collection.children.link(copy_collection(child, share_data, copies, materials))
+    if top_level:
+        # parent the copies to each other, copy() keeps the parent inverse matrix
+        for name, obj_copy in copies.items():
+            parent = bpy.data.objects[name].parent
+            if parent is not None and parent.name in copies:
+                obj_copy.parent = copies[parent.name]
+            remap_references(obj_copy, copies)
+    return collection
+
 
 def load_model(blender_file_name, collection_name):
     '''
@@ -41,11 +348,9 @@ def load_collection(blender_file_name, collection_name):
     Returns a pointer to the collection.
     '''
 
-    # load collection
-    with bpy.data.libraries.load(filepath="//" + blender_file_name, link=False) as (_, dt):
-        dt.collections = [collection_name]
-
-    return dt.collections[0]
+    # copy the cached collection
+    source = load_datablock(blender_file_name, "collections", collection_name)
+    return copy_collection(source, share_data=False)
 
 def load_material(blender_file_name, material_name):
     """
@@ -53,9 +358,7 @@ def load_material(blender_file_name, material_name):
     Returns a pointer to the material.
     """
 
-    with bpy.data.libraries.load(filepath="//" + blender_file_name, link=False) as (_, dt):
-        dt.materials = [material_name]
-    return dt.materials[0]
+    return copy_source(load_datablock(blender_file_name, "materials", material_name))
 
 
 def load_text(blender_file_name, text_name):
@@ -64,6 +367,4 @@ def load_text(blender_file_name, text_name):
     Returns a pointer to the text file.
     """
 
-    with bpy.data.libraries.load(filepath="//" + blender_file_name, link=False) as (_, dt):
-        dt.texts = [text_name]
-    return dt.texts[0]
\ No newline at end of file
+    return copy_source(load_datablock(blender_file_name, "texts", text_name))
@@ -0,0 +1,85 @@
+# Copyright 2019-2022 DADoES, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License in the root directory in the "LICENSE" file or at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    A bounded mapping that evicts the least recently used entries once it holds more than
+    maxsize entries. If maxweight is set, entries are also evicted while the total weight of the
+    entries, measured by weigh(value), is more than maxweight. The most recent entry is always
+    kept. on_evict(key, value) is called for each evicted entry. The cache is safe to use from
+    multiple threads.
+    """
+
+    def __init__(self, maxsize=1024, maxweight=None, weigh=None, on_evict=None):
+        self.maxsize = maxsize
+        self.maxweight = maxweight
+        self.weigh = weigh
+        self.on_evict = on_evict
+        self.hits = 0
+        self.misses = 0
+        self.weight = 0
+        self._entries = OrderedDict()
+        self._weights = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """ Return the value for key and mark it as recently used """
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key, value):
+        """ Add or replace the value for key, evicting old entries if the cache is full """
+        weight = self.weigh(value) if self.weigh is not None else 0
+        evicted = []
+        with self._lock:
+            self.weight += weight - self._weights.get(key, 0)
+            self._weights[key] = weight
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > 1 and (len(self._entries) > self.maxsize or
+                    (self.maxweight is not None and self.weight > self.maxweight)):
+                evicted_key, evicted_value = self._entries.popitem(last=False)
+                self.weight -= self._weights.pop(evicted_key)
+                evicted.append((evicted_key, evicted_value))
+        if self.on_evict is not None:
+            for evicted_key, evicted_value in evicted:
+                self.on_evict(evicted_key, evicted_value)
+
+    def values(self):
+        """ Return a list of the values, least recently used first, without marking them as used """
+        with self._lock:
+            return list(self._entries.values())
+
+    def clear(self):
+        """ Remove all entries without calling on_evict """
+        with self._lock:
+            self._entries.clear()
+            self._weights.clear()
+            self.weight = 0
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
@@ -62,8 +62,16 @@ class Node:
         self.outlinks = {}
         self.schema = ctx.channel.schemas[alias]
         self.input_types = ["values", "links"]
+        # input ports whose schema sets 'lazy: true' receive callables that return the value
+        self.lazy_inputs = {
+            port_dict["name"] for port_dict in (self.schema["inputs"] or []) if port_dict.get("lazy", False)}
         # self.version =
 
+    @property
+    def rng(self):
+        """A numpy.random.Generator with a deterministic stream for this node and interpretation"""
+        return ctx.get_node_rng(self.name)
+
     def configure(self, config):
         """Configure node"""
 
@@ -18,6 +18,13 @@ import anatools.lib.context as ctx
 
 logger = logging.getLogger(__name__)
 
+def get_volume_file_path(file_desc):
+    """
+    Convert a volume file descriptor, 'volume_id:/relative/path', to an absolute path
+    """
+    volume_id, rel_path = file_desc.split(":/")
+    return os.path.join(ctx.data, 'volumes', volume_id, rel_path)
+
 def get_volume_path(package, inpath):
     """
     Convert a volume path to an absolute path
@@ -0,0 +1,154 @@
+# Copyright 2019-2022 DADoES, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License in the root directory in the "LICENSE" file or at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Prefetches asset files while the graph is interpreted. Volumes are usually network mounts, so
+the first read of a file blocks until it has been downloaded. The prefetcher reads the files a
+graph may load on a pool of threads, which fills the page cache and the mount's disk cache
+before the nodes that load them run. Files are read in full and the data is discarded.
+
+The files named by the graph are fetched first, then the object files of the channel packages,
+until the total size reaches the budget set in megabytes with the ANA_PREFETCH_MB environment
+variable (default 4096). When several workers share a work queue only one of them prefetches.
+"""
+import os
+import json
+import time
+import logging
+import threading
+import concurrent.futures
+import anatools.lib.context as ctx
+from anatools.lib.package_utils import get_volume_path, get_volume_file_path
+
+logger = logging.getLogger(__name__)
+
+PREFETCH_THREADS = 4
+READ_SIZE = 8 * 1024 * 1024
+PREFETCH_BUDGET = int(os.environ.get("ANA_PREFETCH_MB", 4096)) * 1024 * 1024
+
+
+def find_graph_assets(plan):
+    """ Return the files named by VolumeFile nodes in an execution plan """
+    files = []
+    for plan_node in plan["nodes"]:
+        node_class = ctx.channel.classes.get(plan_node["alias"], {}).get("class")
+        if node_class != "VolumeFile":
+            continue
+        for file_desc in plan_node["inputs"].get("File", []):
+            if isinstance(file_desc, str) and ":/" in file_desc:
+                files.append(get_volume_file_path(file_desc))
+    return files
+
+
+def find_package_assets(packages):
+    """ Return the files of the objects defined in the package configurations """
+    files = []
+    for package, config in packages.items():
+        for object_type, object_config in (config.get("objects") or {}).items():
+            if isinstance(object_config, dict) and "filename" in object_config:
+                try:
+                    files.append(get_volume_path(package, object_config["filename"]))
+                except (KeyError, ValueError) as e:
+                    logger.warning(f"Can't resolve the file of object '{object_type}' in package '{package}': {e}")
+    return files
+
+
+def read_file(filename, stopped):
+    """ Read a file and return the number of bytes read, or None if stopped is set before the end """
+    size = 0
+    with open(filename, "rb", buffering=0) as f:
+        while not stopped.is_set():
+            data = f.read(READ_SIZE)
+            if not data:
+                return size
+            size += len(data)
+    return None
+
+
+class Prefetcher:
+    """
+    Reads files on a thread pool and records how long each one took. Files are started in order
+    and skipped once their total size would be more than budget bytes.
+    """
+
+    def __init__(self, filenames, threads=PREFETCH_THREADS, budget=PREFETCH_BUDGET):
+        self.results = {}
+        self.budget = budget
+        self._reserved = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads, thread_name_prefix="anatools-prefetch")
+        self._futures = []
+        for filename in dict.fromkeys(filenames):
+            self._futures.append(self._executor.submit(self._fetch, filename))
+
+    def _fetch(self, filename):
+        start = time.perf_counter()
+        result = {"bytes": 0, "seconds": 0.0, "error": None}
+        try:
+            # the size is checked here so a slow volume doesn't hold up the interpretation
+            size = os.path.getsize(filename)
+            with self._lock:
+                if self._reserved + size > self.budget:
+                    self.results[filename] = dict(result, error="over budget")
+                    return
+                self._reserved += size
+            size = read_file(filename, self._stopped)
+            if size is None:
+                result["error"] = "stopped"
+            else:
+                result["bytes"] = size
+        except OSError as e:
+            result["error"] = str(e)
+        result["seconds"] = time.perf_counter() - start
+        with self._lock:
+            self.results[filename] = result
+        if result["error"] is None:
+            logger.info("Prefetched '%s' (%d bytes) in %.2fs", filename, result["bytes"], result["seconds"])
+        elif result["error"] != "stopped":
+            logger.warning("Unable to prefetch '%s': %s", filename, result["error"])
+
+    def close(self, output_dir=None):
+        """
+        Stop prefetching, files that haven't been started are skipped and reads in progress stop
+        after their current block without being waited for. If output_dir is given a report of the
+        fetched files is written to it. Returns the report file name.
+        """
+        # shutdown(cancel_futures=True) needs Python 3.9
+        self._stopped.set()
+        for future in self._futures:
+            future.cancel()
+        self._executor.shutdown(wait=False)
+        with self._lock:
+            results = dict(self.results)
+        fetched = [result for result in results.values() if result["error"] is None]
+        logger.info(
+            "Prefetched %d of %d files, %d bytes in %.2fs", len(fetched), len(self._futures),
+            sum(result["bytes"] for result in fetched), sum(result["seconds"] for result in fetched))
+        if output_dir is None:
+            return None
+        filename = os.path.join(output_dir, f"prefetch-{os.getpid()}.json")
+        with open(filename, "w") as f:
+            json.dump({"requested": len(self._futures), "files": results}, f, indent=2)
+        return filename
+
+
+def start_prefetch(plan, packages, work_queue=None):
+    """
+    Start prefetching the files used by the graph and the objects of the channel packages, up to
+    the prefetch budget. If a work queue is given only the first worker to ask prefetches, the
+    others get None.
+    """
+    if work_queue is not None and not work_queue.claim_prefetch():
+        return None
+    return Prefetcher(find_graph_assets(plan) + find_package_assets(packages))
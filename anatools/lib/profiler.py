@@ -0,0 +1,165 @@
+# Copyright 2019-2022 DADoES, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License in the root directory in the "LICENSE" file or at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Per-node profiling for the interpreter. When profiling is started every node execution records
+wall time, CPU time, peak traced memory and the estimated size of the outputs. The results are
+written as a Chrome trace (chrome://tracing, https://ui.perfetto.dev or https://speedscope.app)
+with a per-class summary of all interpretations run by the process.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# CPU time of the calling thread, thread_time needs python 3.7 so fall back to the process CPU time
+thread_time = getattr(time, "thread_time", time.process_time)
+
+# the profiler used by the interpreter, None when profiling is off
+active_profiler = None
+
+
+def start_profiling():
+    """ Start profiling node executions """
+    global active_profiler
+    active_profiler = Profiler()
+    return active_profiler
+
+
+def stop_profiling(output_dir):
+    """ Stop profiling and write the trace to the output directory. Returns the trace file name. """
+    global active_profiler
+    if active_profiler is None:
+        return None
+    filename = os.path.join(output_dir, f"profile-{os.getpid()}.json")
+    active_profiler.write(filename)
+    active_profiler.close()
+    active_profiler = None
+    return filename
+
+
+def estimate_size(obj, depth=3):
+    """ Estimate the memory used by an object and the containers and arrays it holds """
+    nbytes = getattr(obj, "nbytes", None)
+    if isinstance(nbytes, int):
+        return nbytes
+    size = sys.getsizeof(obj, 0)
+    if depth > 0:
+        if isinstance(obj, dict):
+            size += sum(estimate_size(key, depth-1) + estimate_size(value, depth-1) for key, value in obj.items())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            size += sum(estimate_size(value, depth-1) for value in obj)
+    return size
+
+
+class Profiler:
+    """ Collects node execution events as Chrome trace events """
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.start_time = time.perf_counter()
+        self.events = []
+        self.summary = {}
+        self._lock = threading.Lock()
+        self._started_tracemalloc = not tracemalloc.is_tracing()
+        if self._started_tracemalloc:
+            tracemalloc.start()
+
+    def _timestamp(self, t):
+        # trace timestamps are in microseconds
+        return (t - self.start_time) * 1e6
+
+    def profile_node(self, node, execute=None, status="ok"):
+        """ Execute a node, or call execute(node) if given, and record its profile with the status """
+        # the peak is process wide, so with a thread pool it includes concurrently running nodes
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        start_memory, _ = tracemalloc.get_traced_memory()
+        start_cpu = thread_time()
+        start = time.perf_counter()
+        outputs = node.exec() if execute is None else execute(node)
+        end = time.perf_counter()
+        cpu = thread_time() - start_cpu
+        _, peak_memory = tracemalloc.get_traced_memory()
+        output_size = estimate_size(outputs)
+        event = {
+            "name": node.name,
+            "cat": node.__class__.__name__,
+            "ph": "X",
+            "ts": self._timestamp(start),
+            "dur": (end - start) * 1e6,
+            "pid": self.pid,
+            "tid": threading.get_ident(),
+            "args": {
+                "class": node.__class__.__name__,
+                "status": status,
+                "cpu_ms": cpu * 1e3,
+                "peak_memory_bytes": max(peak_memory - start_memory, 0),
+                "output_bytes": output_size
+            }
+        }
+        with self._lock:
+            self.events.append(event)
+            stats = self.summary.setdefault(node.__class__.__name__, {
+                "count": 0, "wall_ms": 0.0, "cpu_ms": 0.0, "max_peak_memory_bytes": 0, "output_bytes": 0})
+            stats["count"] += 1
+            stats["wall_ms"] += (end - start) * 1e3
+            stats["cpu_ms"] += cpu * 1e3
+            stats["max_peak_memory_bytes"] = max(stats["max_peak_memory_bytes"], event["args"]["peak_memory_bytes"])
+            stats["output_bytes"] += output_size
+        return outputs
+
+    @contextmanager
+    def interpretation(self, interp_num):
+        """ Record the span of an interpretation so node events are grouped by run """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            with self._lock:
+                self.events.append({
+                    "name": f"interp {interp_num}",
+                    "cat": "interpretation",
+                    "ph": "X",
+                    "ts": self._timestamp(start),
+                    "dur": (end - start) * 1e6,
+                    "pid": self.pid,
+                    "tid": threading.get_ident(),
+                    "args": {"interp_num": interp_num}
+                })
+
+    def write(self, filename):
+        """ Write the trace and per-class summary as JSON """
+        with self._lock:
+            trace = {
+                "traceEvents": sorted(self.events, key=lambda event: event["ts"]),
+                "displayTimeUnit": "ms",
+                "otherData": {
+                    "summary": dict(sorted(self.summary.items(), key=lambda item: -item[1]["wall_ms"]))
+                }
+            }
+        with open(filename, "w") as f:
+            json.dump(trace, f)
+        logger.info("Wrote node profile to '%s'", filename)
+
+    def close(self):
+        """ Stop tracing memory if the profiler started it """
+        if self._started_tracemalloc:
+            tracemalloc.stop()
@@ -0,0 +1,157 @@
+# Copyright 2019-2022 DADoES, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License in the root directory in the "LICENSE" file or at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+A long-lived interpreter for Python channels. The channel is loaded and set up once, then jobs are
+read from a Unix socket and interpreted one at a time in the same process. Each request is one line
+of JSON and gets one line of JSON back, e.g.
+
+    {"graph": "graphs/default.yml", "seed": 42, "interp_num": 3, "output": "./output/3"}
+    {"interp_num": 3, "success": true, "error": null}
+
+Only "graph" is required, the other fields default to the server's execution flags. A client may
+send any number of jobs on one connection. Send {"command": "shutdown"} to stop the server.
+"""
+import os
+import json
+import stat
+import socket
+import logging
+import threading
+import socketserver
+import anatools.lib.context as ctx
+import anatools.lib.events as events
+from anatools.lib.interp import interp_plan, load_plan
+
+logger = logging.getLogger(__name__)
+
+
+def run_job(channel, job):
+    """ Interpret the graph of a job. Returns the response sent to the client. """
+    interp_num = job.get("interp_num", channel.execution_flags["--interp_num"])
+    try:
+        ctx.initialize(
+            channel=channel,
+            seed=job.get("seed", channel.execution_flags["--seed"]),
+            interp_num=interp_num,
+            preview=job.get("preview", channel.execution_flags["--preview"]),
+            output=job.get("output", channel.execution_flags["--output"]),
+            data=job.get("data", channel.execution_flags["--data"]),
+            rng=job.get("rng", channel.execution_flags["--rng"]))
+        # the plan key depends on the channel in the context
+        plan = load_plan(job["graph"], prune=job.get("prune", channel.execution_flags["--prune"]))
+        interp_plan(plan, threads=job.get("threads", channel.execution_flags["--threads"]))
+    except (Exception, SystemExit) as e:
+        # nodes and the interpreter exit on errors, only that job fails
+        message = f"An exception of type {type(e).__name__} occurred while interpreting graph (interp_num {interp_num})"
+        logging.error(message, exc_info=e)
+        return {"interp_num": interp_num, "success": False, "error": f"{type(e).__name__}: {e}"}
+    return {"interp_num": interp_num, "success": True, "error": None}
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    """ Run the jobs sent on a connection and reply to each one """
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                job = json.loads(line)
+                if not isinstance(job, dict):
+                    raise ValueError("a job must be a JSON object")
+                if job.get("command") == "shutdown":
+                    # shutdown waits for serve_forever to return so it can't be called from this thread
+                    threading.Thread(target=self.server.shutdown).start()
+                    self.reply({"success": True, "error": None})
+                    return
+                if "graph" not in job:
+                    raise ValueError("a job must have a graph")
+            except ValueError as e:
+                self.reply({"success": False, "error": f"Invalid job: {e}"})
+                continue
+            self.reply(run_job(self.server.channel, job))
+
+    def reply(self, response):
+        self.wfile.write((json.dumps(response) + "\n").encode())
+        self.wfile.flush()
+
+
+class JobServer(socketserver.UnixStreamServer):
+    """
+    Serves jobs for a channel. Connections are handled one at a time because the interpreter
+    context is global to the process.
+    """
+
+    def __init__(self, socket_path, channel):
+        self.channel = channel
+        super().__init__(socket_path, JobHandler)
+
+
+def remove_stale_socket(socket_path):
+    """
+    Remove the socket of a server that wasn't shut down cleanly. Raises ValueError if the path is
+    anything other than a socket or another server is listening on it.
+    """
+    try:
+        mode = os.lstat(socket_path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        logger.critical(f"Can't serve on '{socket_path}', the path exists and isn't a socket")
+        raise ValueError
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except OSError:
+            # nothing is listening so the socket is stale
+            os.remove(socket_path)
+            return
+    logger.critical(f"Can't serve on '{socket_path}', another server is listening on it")
+    raise ValueError
+
+
+def serve(channel, socket_path):
+    """ Set up the channel and interpret jobs sent to the Unix socket until the server is shut down """
+    if channel.type != "python":
+        logger.critical(f"Only python channels can be served, '{channel.name}' is a {channel.type} channel")
+        raise ValueError
+    remove_stale_socket(socket_path)
+    channel.setup()
+    if channel.execution_flags["--event_log"] is not None:
+        events.start_event_stream(channel.execution_flags["--event_log"])
+
+    server = JobServer(socket_path, channel)
+    logger.info(f"Serving channel '{channel.name}' on {socket_path}")
+    try:
+        server.serve_forever(poll_interval=0.1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        events.stop_event_stream()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+def submit(socket_path, jobs):
+    """ Send jobs to a server and return the responses in the same order """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        with sock.makefile("rwb") as f:
+            responses = []
+            for job in jobs:
+                f.write((json.dumps(job) + "\n").encode())
+                f.flush()
+                responses.append(json.loads(f.readline()))
+    return responses
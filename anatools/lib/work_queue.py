@@ -0,0 +1,138 @@
+# Copyright 2019-2022 DADoES, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License in the root directory in the "LICENSE" file or at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+A queue of interpretation numbers shared by a pool of interpreter processes. Workers claim one
+interpretation at a time when they are ready for more work, so a slow interpretation never leaves
+the other workers idle. The queue is a JSON file guarded by an exclusive file lock which works
+across Blender and Python processes without any extra services.
+"""
+import os
+import json
+import time
+import fcntl
+import tempfile
+import subprocess
+
+
+class WorkQueue:
+    """ File based work queue of interpretation numbers """
+
+    def __init__(self, path):
+        self.path = path
+
+    @classmethod
+    def create(cls, path, interp_nums):
+        """ Create a new queue file containing the interpretation numbers """
+        state = {
+            "pending": list(interp_nums),
+            "running": {},
+            "done": [],
+            "failed": [],
+            "prefetch": None
+        }
+        with open(path, "w") as f:
+            json.dump(state, f)
+        return cls(path)
+
+    def _update(self, method):
+        """ Apply method to the queue state while holding the lock and save the result """
+        with open(self.path, "r+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                state = json.load(f)
+                result = method(state)
+                f.seek(0)
+                f.truncate()
+                json.dump(state, f)
+                # write the state before another process can take the lock
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return result
+
+    def claim(self):
+        """ Claim the next pending interpretation number. Returns None when the queue is empty. """
+        def claim_next(state):
+            if len(state["pending"]) == 0:
+                return None
+            interp_num = state["pending"].pop(0)
+            state["running"][str(interp_num)] = os.getpid()
+            return interp_num
+        return self._update(claim_next)
+
+    def claim_prefetch(self):
+        """ Return True for the first worker to ask, so assets are only prefetched once per batch """
+        def claim(state):
+            if state.get("prefetch") is not None:
+                return False
+            state["prefetch"] = os.getpid()
+            return True
+        return self._update(claim)
+
+    def finish(self, interp_num, success=True):
+        """ Mark a claimed interpretation as done or failed """
+        def mark_finished(state):
+            state["running"].pop(str(interp_num), None)
+            state["done" if success else "failed"].append(interp_num)
+        self._update(mark_finished)
+
+    def state(self):
+        """ Return a snapshot of the queue state """
+        return self._update(lambda state: dict(state))
+
+    def __iter__(self):
+        """ Claim interpretation numbers until the queue is empty """
+        while True:
+            interp_num = self.claim()
+            if interp_num is None:
+                return
+            yield interp_num
+
+
+def run_workers(command, interp_nums, workers):
+    """
+    Run interpretations on a pool of worker processes that share a work queue. The command is
+    the interpreter command line without batch flags, each worker gets '--work_queue <file>'
+    appended. A worker that exits while work is still pending is replaced so a crashed
+    interpretation doesn't stop the batch. Returns 0 if every interpretation succeeded.
+    """
+    fd, path = tempfile.mkstemp(prefix="ana_work_queue_", suffix=".json")
+    os.close(fd)
+    queue = WorkQueue.create(path, interp_nums)
+    worker_command = command + f' \\\n--work_queue {path}'
+    processes = []
+    try:
+        for _ in range(min(workers, len(interp_nums))):
+            processes.append(subprocess.Popen(worker_command, shell=True))
+        restarts = 0
+        while len(processes) > 0:
+            time.sleep(0.1)
+            for process in [process for process in processes if process.poll() is not None]:
+                processes.remove(process)
+                if len(queue.state()["pending"]) > 0 and restarts < len(interp_nums):
+                    restarts += 1
+                    processes.append(subprocess.Popen(worker_command, shell=True))
+        state = queue.state()
+    finally:
+        for process in processes:
+            process.terminate()
+        os.remove(path)
+
+    # interpretations still marked running belonged to a worker that died
+    failed = sorted(state["failed"] + [int(interp_num) for interp_num in state["running"]] + state["pending"])
+    print(f'{len(state["done"])} of {len(interp_nums)} interpretations succeeded.')
+    if len(failed) > 0:
+        print(f'Failed interpretations: {", ".join(str(interp_num) for interp_num in failed)}')
+        return 1
+    return 0
@@ -19,26 +19,26 @@ logger = logging.getLogger(__name__)
 
 
 class ConditionalSelector(Node):
+    """
+    Select one of two values based on a condition. The 'True' and 'False' inputs are lazy so only
+    the branch that is selected gets executed.
+    """
 
     def exec(self):
         logger.info("Executing {}".format(self.name))
         # parse the inputs
-        value = None
-        a = float(self.inputs['ConditionA'][0])
+        a = float(self.inputs['ConditionalA'][0])
         operator = str(self.inputs['Operator'][0])
-        b = float(self.inputs['ConditionB'][0])
-        t = self.inputs['True'][0]
-        f = self.inputs['False'][0]
+        b = float(self.inputs['ConditionalB'][0])
         if operator == "Less Than":
-            if a < b:   value = t
-            else:       value = f
+            condition = a < b
         elif operator == "Equal To":
-            if a == b:  value = t
-            else:       value = f
+            condition = a == b
         elif operator == "Greater Than":
-            if a > b:   value = t
-            else:       value = f
+            condition = a > b
         else:
             logger.error("Encountered invalid value for Operator: {}. Exiting...".format(operator))
             sys.exit(1)
+        if condition:   value = self.inputs['True'][0]()
+        else:           value = self.inputs['False'][0]()
         return {"Value": value}
@@ -1,8 +1,7 @@
 import logging
-import os
 from anatools.lib.node import Node
-import anatools.lib.context as ctx
 from anatools.lib.file_handlers import FileObject
+from anatools.lib.package_utils import get_volume_file_path
 
 logger = logging.getLogger(__name__)
 
@@ -13,8 +12,7 @@ class VolumeFile(Node):
         """Execute node"""
 
         file_desc = self.inputs["File"][0]
-        volume_id, rel_path = file_desc.split(":/")
-        filename = os.path.join(ctx.data, 'volumes', volume_id, rel_path)
+        filename = get_volume_file_path(file_desc)
         file_object = FileObject(filename)
 
         return {"File": file_object}